@@ -0,0 +1,121 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""
+Memory allocated between the image buffer and can.Message construction.
+
+Writes a synthetic image through STM32Protocol._write over a bus that
+acknowledges every frame immediately and measures, with tracemalloc,
+how much memory each page allocates above what was live before it and
+how many blocks it leaves allocated (sys.getallocatedblocks). The
+slicing path used before segments were passed as memoryviews is
+measured alongside.
+
+    python -m benchmarks.alloc [-s SIZE]
+"""
+
+import argparse
+import can
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+
+from canprog import logger
+from canprog.protocols import stm32
+
+class AckBus(can.BusABC):
+    
+    def __init__(self):
+        super().__init__(channel=None)
+        self._ack = can.Message(arbitration_id=stm32.CMD_WRITE_MEMORY, data=(stm32.BYTE_ACK,), is_extended_id=False)
+    
+    def send(self, msg, timeout=None):
+        pass
+    
+    def _recv_internal(self, timeout):
+        return self._ack, False
+
+class PageAllocations(object):
+    
+    def __init__(self):
+        self.allocated = []
+        self.blocks = 0
+        self.start()
+    
+    def start(self):
+        tracemalloc.reset_peak()
+        self._traced = tracemalloc.get_traced_memory()[0]
+        self._blocks = sys.getallocatedblocks()
+    
+    def __call__(self, address, size):
+        blocks = sys.getallocatedblocks()
+        self.allocated.append(tracemalloc.get_traced_memory()[1] - self._traced)
+        self.blocks += blocks - self._blocks
+        self.start()
+
+class BenchSTM32Protocol(stm32.STM32Protocol):
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._supported_commands[stm32.CMD_WRITE_MEMORY]['support'] = True
+
+class SlicingSTM32Protocol(BenchSTM32Protocol):
+    
+    def _write(self, address, data, progress=None):
+        data = bytes(data)
+        for i in range(0, len(data), 256):
+            page = data[i:i+256]
+            self._write_page(address+i, page)
+            progress(address+i, len(page))
+
+def measure(protocol_class, image):
+    bus = AckBus()
+    try:
+        protocol = protocol_class(bus)
+        tracemalloc.start()
+        pages = PageAllocations()
+        wall = time.perf_counter()
+        protocol.write(stm32.FLASH_BASE, image, pages)
+        wall = time.perf_counter() - wall
+        tracemalloc.stop()
+    finally:
+        bus.shutdown()
+    return pages, wall
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory allocated in the write hot loop')
+    parser.add_argument('-s', dest='size', type=lambda x: int(x,0), default=0x40000, help='image size in bytes (default: 0x40000)')
+    params = parser.parse_args()
+    
+    logger.set_level(logging.WARNING)
+    
+    image = memoryview(bytearray(i & 0xFF for i in range(params.size)))
+    for name, protocol_class in (('slicing', SlicingSTM32Protocol), ('memoryview', BenchSTM32Protocol)):
+        pages, wall = measure(protocol_class, image)
+        print('{:<11} per page median {:6.0f} B  max {:7d} B  blocks kept {:6d}  wall {:6.3f}s'.format(name, statistics.median(pages.allocated), max(pages.allocated), pages.blocks, wall))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""
+Host time per board when flashing the same image many times.
+
+Writes a synthetic Intel HEX image to a number of boards over a bus that
+acknowledges every frame immediately, once parsing the file and writing
+segments for every board as the write command did, and once from a plan
+made by compile, where frames are built for the first board only.
+
+    python -m benchmarks.plan [-s SIZE] [-b BOARDS]
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from benchmarks.alloc import AckBus
+from canprog import file
+from canprog import logger
+from canprog import plan
+from canprog.protocols import stm32
+
+def make_protocol(bus):
+    protocol = stm32.STM32Protocol(bus)
+    protocol._supported_commands[stm32.CMD_WRITE_MEMORY]['support'] = True
+    return protocol
+
+def flash_image(bus, filename):
+    datafile = file.FileManager()
+    datafile.load(filename, 'hex')
+    protocol = make_protocol(bus)
+    for address, data in datafile.get_segments():
+        protocol.write(address, data)
+
+def flash_plan(bus, compiled):
+    protocol = make_protocol(bus)
+    for address, data, pages in compiled.segments:
+        protocol.write_plan(pages)
+
+def measure(function, boards, *args):
+    bus = AckBus()
+    try:
+        times = []
+        for n in range(boards):
+            start = time.perf_counter()
+            function(bus, *args)
+            times.append(time.perf_counter() - start)
+    finally:
+        bus.shutdown()
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description='Host time per board, image file against compiled plan')
+    parser.add_argument('-s', dest='size', type=lambda x: int(x,0), default=0x10000, help='image size in bytes (default: 0x10000)')
+    parser.add_argument('-b', dest='boards', type=int, default=10, help='boards to flash (default: 10)')
+    params = parser.parse_args()
+    
+    logger.set_level(logging.WARNING)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        image = file.FileManager()
+        image.set_segment(stm32.FLASH_BASE, os.urandom(params.size))
+        hex_filename = os.path.join(tmp, 'image.hex')
+        image.save(hex_filename, 'hex')
+        plan_filename = os.path.join(tmp, 'image.plan')
+        plan.compile_plan(image).save(plan_filename)
+        
+        results = (
+            ('image', measure(flash_image, params.boards, hex_filename)),
+            ('plan', measure(flash_plan, params.boards, plan.load(plan_filename))),
+        )
+    
+    for name, times in results:
+        rest = times[1:] or times
+        print('{:<6} first {:7.3f}s  next {:7.3f}s/board  total {:7.3f}s'.format(name, times[0], sum(rest) / len(rest), sum(times)))
+
+if __name__ == '__main__':
+    main()
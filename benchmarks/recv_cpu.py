@@ -0,0 +1,87 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""
+Host CPU cost of waiting for bootloader responses.
+
+Flashes a synthetic image into the simulated bootloader on the python-can
+virtual bus, once with the legacy busy-poll receive loop and once with
+the blocking receive path, and reports host CPU time per flashed
+kilobyte for both.
+
+    python -m benchmarks.recv_cpu [-s SIZE] [-l LATENCY]
+"""
+
+import argparse
+import can
+import time
+
+from canprog.protocols import abstract
+from canprog.protocols import stm32
+from canprog.tests.simulator import STM32Simulator
+
+CHANNEL = 'canprog-bench'
+
+class PollingSTM32Protocol(stm32.STM32Protocol):
+    
+    def _recv(self, timeout=None, checker=None):
+        t = self.RECV_TIMEOUT if timeout == None else timeout
+        start = abstract.current_time()
+        while abstract.current_time() - start < t:
+            frame = self._iface.recv(0.0)
+            if frame and (checker == None or checker(frame)):
+                return frame
+        raise TimeoutError('Receiving timeout')
+
+def measure(protocol_class, size, latency):
+    with STM32Simulator(CHANNEL, latency=latency):
+        bus = can.interface.Bus(channel=CHANNEL, interface='virtual')
+        try:
+            protocol = protocol_class(bus)
+            data = bytes(i & 0xFF for i in range(size))
+            
+            wall = time.perf_counter()
+            cpu = time.thread_time()
+            for i in range(0, size, 256):
+                protocol._write_page(stm32.FLASH_BASE+i, data[i:i+256])
+            cpu = time.thread_time() - cpu
+            wall = time.perf_counter() - wall
+        finally:
+            bus.shutdown()
+        
+    return (wall, cpu)
+
+def main():
+    parser = argparse.ArgumentParser(description='Host CPU time per flashed kilobyte')
+    parser.add_argument('-s', dest='size', type=lambda x: int(x,0), default=0x4000, help='image size in bytes (default: 0x4000)')
+    parser.add_argument('-l', dest='latency', type=float, default=0.0005, help='simulated response latency in seconds (default: 0.0005)')
+    params = parser.parse_args()
+    
+    kbytes = params.size / 1024.0
+    for name, protocol_class in (('busy-poll', PollingSTM32Protocol), ('blocking', stm32.STM32Protocol)):
+        wall, cpu = measure(protocol_class, params.size, params.latency)
+        print('{:<10} wall {:7.3f}s  cpu {:7.3f}s  cpu/KiB {:7.2f}ms'.format(name, wall, cpu, 1000.0 * cpu / kbytes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""
+Import time of the command line entry point.
+
+Runs python -X importtime on canprog.main several times and reports the
+best cumulative import time with the slowest imports under it. Exits
+with status 1 when that time is over the budget or when a module that
+only commands talking to a bus need (python-can, asyncio, http.server)
+is imported on startup, so it can guard a CI job.
+
+    python -m benchmarks.startup [-b BUDGET_MS] [-r RUNS]
+"""
+
+import argparse
+import sys
+
+from canprog.tests.test_startup import HEAVY_MODULES, IMPORT_BUDGET_MS, import_times
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup import time against a budget')
+    parser.add_argument('-b', dest='budget', type=float, default=IMPORT_BUDGET_MS, help='budget for importing canprog.main in ms (default: %(default)s)')
+    parser.add_argument('-r', dest='runs', type=int, default=5, help='runs, the best one counts (default: 5)')
+    parser.add_argument('-m', dest='module', default='canprog.main', help='module to import (default: canprog.main)')
+    params = parser.parse_args()
+    
+    best = None
+    for n in range(params.runs):
+        times = import_times(params.module)
+        if best == None or times[params.module] < best[params.module]:
+            best = times
+    
+    total = best[params.module] / 1000.0
+    print('{:<28} {:8.1f} ms  (budget {:.1f} ms)'.format(params.module, total, params.budget))
+    for name, us in sorted(best.items(), key=lambda item: -item[1])[1:6]:
+        print('  {:<26} {:8.1f} ms'.format(name, us / 1000.0))
+    
+    failed = False
+    heavy = [name for name in HEAVY_MODULES if name in best]
+    if len(heavy) > 0:
+        print('imported on startup: '+', '.join(heavy))
+        failed = True
+    if total > params.budget:
+        print('over budget by {:.1f} ms'.format(total - params.budget))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""
+Throughput of the STM32 read, write, erase and verify paths.
+
+Runs each operation against the simulated bootloader on the python-can
+virtual bus for every combination of protocol (classic CAN or CAN FD),
+image size and response latency, and emits frames/s, bytes/s, host CPU
+time and p50/p99 frame round-trip as JSON so results can be compared
+between releases.
+
+    python -m benchmarks.throughput [-p PROTOCOL ...] [-s SIZE ...] [-l LATENCY ...] [-o FILE]
+"""
+
+import argparse
+import can
+import json
+import logging
+import platform
+import sys
+import time
+
+from canprog import __version__
+from canprog import main as canprog_main
+from canprog import logger
+from canprog.protocols import stm32
+from canprog.tests.simulator import STM32Simulator
+
+CHANNEL = 'canprog-bench'
+
+OPERATIONS = ('erase', 'write', 'read', 'read-pipelined', 'verify')
+
+class TimedSTM32Protocol(stm32.STM32Protocol):
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_stats()
+    
+    def reset_stats(self):
+        self.frames = 0
+        self.round_trips = []
+        self._last_send = None
+    
+    def _send(self, msg):
+        super()._send(msg)
+        self.frames += 1
+        self._last_send = time.perf_counter()
+    
+    def _recv(self, timeout=None, checker=None):
+        msg = super()._recv(timeout, checker)
+        self.frames += 1
+        if self._last_send != None:
+            self.round_trips.append(time.perf_counter() - self._last_send)
+            self._last_send = None
+        return msg
+
+class TimedSTM32FDProtocol(stm32.STM32FDMixin, TimedSTM32Protocol):
+    pass
+
+PROTOCOLS = {
+    'stm32': TimedSTM32Protocol,
+    'stm32fd': TimedSTM32FDProtocol,
+}
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def covering_sectors(protocol, address, size):
+    return [n for n, start, length in protocol.sectors() if start < address + size and address < start + length]
+
+def run_operation(protocol, operation, address, data):
+    if operation == 'erase':
+        protocol.erase(covering_sectors(protocol, address, len(data)))
+    elif operation == 'write':
+        protocol.write(address, data)
+    elif operation == 'read':
+        protocol.read_pipeline = False
+        protocol.read(address, len(data))
+    elif operation == 'read-pipelined':
+        protocol.read_pipeline = True
+        protocol.read(address, len(data))
+        protocol.read_pipeline = False
+    elif operation == 'verify':
+        canprog_main.verify(protocol, address, data)
+
+def measure(protocol_name, size, latency, erase_time):
+    results = []
+    data = bytes((i * 7) & 0xFF for i in range(size))
+    protocol_class = PROTOCOLS[protocol_name]
+    with STM32Simulator(CHANNEL, latency=latency, erase_time=erase_time, fd=protocol_class.FD):
+        bus = can.interface.Bus(channel=CHANNEL, interface='virtual')
+        try:
+            protocol = protocol_class(bus)
+            protocol.connect()
+            for operation in OPERATIONS:
+                protocol.reset_stats()
+                wall = time.perf_counter()
+                cpu = time.thread_time()
+                run_operation(protocol, operation, stm32.FLASH_BASE, data)
+                cpu = time.thread_time() - cpu
+                wall = time.perf_counter() - wall
+                p50 = percentile(protocol.round_trips, 50)
+                p99 = percentile(protocol.round_trips, 99)
+                results.append({ 'protocol': protocol_name,
+                                 'operation': operation,
+                                 'size': size,
+                                 'latency': latency,
+                                 'seconds': wall,
+                                 'cpu_seconds': cpu,
+                                 'frames': protocol.frames,
+                                 'frames_per_s': protocol.frames / wall,
+                                 'bytes_per_s': size / wall,
+                                 'rtt_p50_ms': None if p50 == None else 1000.0 * p50,
+                                 'rtt_p99_ms': None if p99 == None else 1000.0 * p99, })
+        finally:
+            bus.shutdown()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Read/write/erase/verify throughput on the simulated bootloader')
+    parser.add_argument('-p', dest='protocols', choices=sorted(PROTOCOLS), nargs='+', default=['stm32', 'stm32fd'], help='protocols to compare (default: stm32 stm32fd)')
+    parser.add_argument('-s', dest='sizes', type=lambda x: int(x,0), nargs='+', default=[0x1000, 0x4000, 0x10000], help='image sizes in bytes (default: 0x1000 0x4000 0x10000)')
+    parser.add_argument('-l', dest='latencies', type=float, nargs='+', default=[0.0, 0.0002, 0.001], help='simulated response latencies in seconds (default: 0 0.0002 0.001)')
+    parser.add_argument('-e', dest='erase_time', type=float, default=0.0, help='simulated erase time per sector in seconds (default: 0)')
+    parser.add_argument('-o', dest='output', default=None, help='output JSON file (default: stdout)')
+    params = parser.parse_args()
+    
+    logger.set_level(logging.WARNING)
+    
+    results = []
+    for protocol_name in params.protocols:
+        for latency in params.latencies:
+            for size in params.sizes:
+                results += measure(protocol_name, size, latency, params.erase_time)
+    
+    report = { 'canprog': __version__,
+               'python': platform.python_version(),
+               'python_can': can.__version__,
+               'timestamp': time.time(),
+               'results': results, }
+    
+    if params.output == None:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(params.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
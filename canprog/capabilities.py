@@ -0,0 +1,87 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import json
+import os
+import threading
+
+from canprog import cache
+
+class CapabilityCache(object):
+    '''
+    Commands supported by a bootloader, stored per chip ID and bootloader
+    version so a known target is connected without the GET exchange. With
+    refresh, stored entries are ignored and replaced by fresh ones.
+    '''
+    
+    def __init__(self, protocol, refresh=False, path=None):
+        if path == None:
+            path = cache.get_cache_path('capabilities-{protocol}.json'.format(protocol=protocol))
+        self._path = path
+        self._refresh = refresh
+        self._lock = threading.Lock()
+    
+    def _key(self, chip_id, version):
+        return '{chip}-0x{version:02X}'.format(chip=chip_id, version=version)
+    
+    def _load(self):
+        try:
+            with open(self._path, 'r') as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(content, dict):
+            return {}
+        return content
+    
+    def get(self, chip_id, version):
+        if self._refresh:
+            return None
+        with self._lock:
+            commands = self._load().get(self._key(chip_id, version))
+        if not isinstance(commands, list):
+            return None
+        return commands
+    
+    def put(self, chip_id, version, commands):
+        with self._lock:
+            content = self._load()
+            content[self._key(chip_id, version)] = list(commands)
+            tmp = '{path}.{pid}.{thread}.tmp'.format(path=self._path, pid=os.getpid(), thread=threading.get_ident())
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(content, f, indent=1, sort_keys=True)
+                os.replace(tmp, self._path)
+            except OSError:
+                pass
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(protocol, refresh=False):
+    with _caches_lock:
+        key = (protocol, refresh)
+        if key not in _caches:
+            _caches[key] = CapabilityCache(protocol, refresh)
+        return _caches[key]
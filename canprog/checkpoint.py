@@ -0,0 +1,85 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import hashlib
+import json
+import os
+import struct
+
+from canprog import cache
+
+SAVE_PAGES = 16
+
+def image_hash(segments):
+    h = hashlib.sha256()
+    for address, data in segments:
+        h.update(struct.pack('>II', address, len(data)))
+        h.update(data)
+    return h.hexdigest()
+
+class Checkpoint(object):
+    
+    def __init__(self, name, chip_id, image):
+        self._path = cache.get_cache_path('write-{name}-{chip}-{image}.json'.format(name=name, chip=chip_id, image=image[:16]))
+        self._image = image
+        self._written = {}
+    
+    def load(self):
+        try:
+            with open(self._path, 'r') as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if content.get('image') != self._image:
+            return False
+        self._written = {int(k): v for k, v in content.get('written', {}).items()}
+        return True
+    
+    def _save(self):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'image': self._image, 'written': self._written}, f)
+        os.replace(tmp, self._path)
+    
+    def written(self, address):
+        return self._written.get(address, 0)
+    
+    def progress(self, segment_address):
+        pages = [0]
+        def callback(address, size):
+            self._written[segment_address] = address + size - segment_address
+            pages[0] += 1
+            if pages[0] % SAVE_PAGES == 1:
+                self._save()
+        return callback
+    
+    def clear(self):
+        self._written = {}
+        self.remove()
+    
+    def remove(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
@@ -22,36 +22,242 @@
 # THE SOFTWARE.
 #
 
-import intelhex
+import bisect
+import mmap
+import os
+
+HEX_DATA = 0x00
+HEX_EOF = 0x01
+HEX_EXTENDED_SEGMENT_ADDRESS = 0x02
+HEX_START_SEGMENT_ADDRESS = 0x03
+HEX_EXTENDED_LINEAR_ADDRESS = 0x04
+HEX_START_LINEAR_ADDRESS = 0x05
+
+HEX_RECORD_SIZE = 16
+
+def hex_record(rtype, address, data=b''):
+    record = bytearray((len(data), (address>>8)&0xFF, address&0xFF, rtype,))
+    record += data
+    record.append((-sum(record))&0xFF)
+    return ':'+record.hex().upper()+'\n'
+
+def parse_hex_record(line):
+    if line[0] != ':':
+        raise ValueError('Invalid hex record')
+    try:
+        record = bytes.fromhex(line[1:])
+    except ValueError:
+        raise ValueError('Invalid hex record')
+    if len(record) < 5 or len(record) != record[0] + 5:
+        raise ValueError('Invalid hex record length')
+    if sum(record) & 0xFF != 0:
+        raise ValueError('Invalid hex record checksum')
+    return (record[3], (record[1]<<8) | record[2], record[4:-1],)
+
+def read_hex(f):
+    base = 0
+    for n, line in enumerate(f, 1):
+        line = line.strip()
+        if line == '':
+            continue
+        try:
+            rtype, address, data = parse_hex_record(line)
+        except ValueError as e:
+            raise ValueError('{} at line {}'.format(e, n))
+        
+        if rtype == HEX_DATA:
+            yield (base + address, data,)
+        elif rtype == HEX_EOF:
+            return
+        elif rtype == HEX_EXTENDED_SEGMENT_ADDRESS:
+            base = ((data[0]<<8) | data[1]) << 4
+        elif rtype == HEX_EXTENDED_LINEAR_ADDRESS:
+            base = ((data[0]<<8) | data[1]) << 16
+        elif rtype in (HEX_START_SEGMENT_ADDRESS, HEX_START_LINEAR_ADDRESS):
+            pass
+        else:
+            raise ValueError('Unsupported hex record type at line {}'.format(n))
+
+def scan_hex(f, address):
+    base = 0
+    end = address
+    position = 0
+    offset = 0
+    for line in f:
+        offset += len(line)
+        try:
+            rtype, record_address, data = parse_hex_record(line.strip().decode('ascii'))
+        except (ValueError, UnicodeDecodeError, IndexError):
+            break
+        if rtype == HEX_DATA:
+            if base + record_address != end:
+                break
+            end += len(data)
+            position = offset
+        elif rtype == HEX_EXTENDED_LINEAR_ADDRESS:
+            base = ((data[0]<<8) | data[1]) << 16
+        elif rtype == HEX_EOF:
+            break
+    return (position, end,)
+
+class HexWriter(object):
+    
+    def __init__(self, f):
+        self._f = f
+        self._upper = None
+    
+    def write(self, address, data):
+        data = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            upper = (address + offset) >> 16
+            if upper != self._upper:
+                self._f.write(hex_record(HEX_EXTENDED_LINEAR_ADDRESS, 0, bytes((upper>>8, upper&0xFF,))))
+                self._upper = upper
+            lower = (address + offset) & 0xFFFF
+            size = min(HEX_RECORD_SIZE, len(data) - offset, 0x10000 - lower)
+            self._f.write(hex_record(HEX_DATA, lower, data[offset:offset+size]))
+            offset += size
+    
+    def close(self):
+        self._f.write(hex_record(HEX_EOF, 0))
+
+class FileSink(object):
+    
+    PAGE_SIZE = 256
+    
+    def __init__(self, filename, fmt, address, resume=False):
+        self.address = address
+        self._writer = None
+        if fmt == 'bin':
+            self._f = open(filename, 'ab' if resume else 'wb')
+            done = self._f.tell()
+            done -= done % self.PAGE_SIZE
+            self._f.truncate(done)
+            self.address += done
+        elif fmt == 'hex':
+            if resume and os.path.exists(filename):
+                self._f = open(filename, 'r+b')
+                position, self.address = scan_hex(self._f, address)
+                self._f.seek(position)
+                self._f.truncate(position)
+            else:
+                self._f = open(filename, 'wb')
+            self._writer = HexWriter(_AsciiWriter(self._f))
+        else:
+            raise ValueError('Unsupported file format type')
+    
+    def __call__(self, address, data):
+        if address != self.address:
+            raise ValueError('Non-contiguous data at 0x{:08X}'.format(address))
+        if self._writer != None:
+            self._writer.write(address, data)
+        else:
+            self._f.write(data)
+        self._f.flush()
+        self.address += len(data)
+    
+    def close(self):
+        if self._writer != None:
+            self._writer.close()
+        self._f.close()
+
+class _AsciiWriter(object):
+    
+    def __init__(self, f):
+        self._f = f
+    
+    def write(self, text):
+        self._f.write(text.encode('ascii'))
 
 class FileManager(object):
     def __init__(self):
-        self._ih = intelhex.IntelHex()
+        self._starts = []
+        self._buffers = []
         
     def load(self, filename, fmt, address=0):
         if fmt == 'bin':
-            self._ih.loadbin(filename, offset=address)
+            with open(filename, 'rb') as f:
+                try:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    return
+            self._add(address, data)
         elif fmt == 'hex':
-            self._ih.loadhex(filename)
+            with open(filename, 'r') as f:
+                run_start = None
+                run = bytearray()
+                for record_address, data in read_hex(f):
+                    if run_start != None and record_address == run_start + len(run):
+                        run += data
+                        continue
+                    if run_start != None:
+                        self._add(run_start, run)
+                    run_start = record_address
+                    run = bytearray(data)
+                if run_start != None:
+                    self._add(run_start, run)
         else:
             raise ValueError('Unsupported file format type')
+    
+    def _add(self, address, data):
+        end = address + len(data)
+        if len(data) == 0:
+            return
+        
+        lo = bisect.bisect_left(self._starts, address)
+        if lo > 0 and self._starts[lo-1] + len(self._buffers[lo-1]) >= address:
+            lo -= 1
+        hi = bisect.bisect_right(self._starts, end)
+        
+        if lo == hi:
+            self._starts.insert(lo, address)
+            self._buffers.insert(lo, data)
+            return
+        
+        start = min(address, self._starts[lo])
+        stop = max(end, self._starts[hi-1] + len(self._buffers[hi-1]))
+        
+        merged = bytearray(stop - start)
+        for i in range(lo, hi):
+            offset = self._starts[i] - start
+            merged[offset:offset+len(self._buffers[i])] = self._buffers[i]
+        merged[address-start:end-start] = data
+        
+        self._starts[lo:hi] = [start]
+        self._buffers[lo:hi] = [merged]
         
     def get_segments(self):
-        for s in self._ih.segments():
-            address = s[0]
-            size = s[1]-address
-            data = self._ih.tobinarray(start=address, size=size)
-            yield (address, data,)
+        for address, data in zip(self._starts, self._buffers):
+            yield (address, memoryview(data),)
+    
+    def get_data(self, address, size):
+        i = bisect.bisect_right(self._starts, address) - 1
+        if i < 0:
+            return None
+        offset = address - self._starts[i]
+        if offset + size > len(self._buffers[i]):
+            return None
+        return bytes(self._buffers[i][offset:offset+size])
             
     def set_segment(self, address, data):
-        for b in data:
-            data = self._ih[address] = b
-            address += 1
+        self._add(address, bytearray(data))
             
     def save(self, filename, fmt):
         if fmt == 'bin':
-            self._ih.tobinfile(filename)
+            with open(filename, 'wb') as f:
+                if len(self._starts) == 0:
+                    return
+                position = self._starts[0]
+                for address, data in self.get_segments():
+                    f.write(b'\xFF' * (address - position))
+                    f.write(data)
+                    position = address + len(data)
         elif fmt == 'hex':
-            self._ih.write_hex_file(filename, write_start_addr=False)
+            with open(filename, 'w') as f:
+                writer = HexWriter(f)
+                for address, data in self.get_segments():
+                    writer.write(address, data)
+                writer.close()
         else:
             raise ValueError('Unsupported file format type')
@@ -26,10 +26,13 @@ import logging
 
 from canprog import __appname__
 
+FORMAT = '[%(asctime)s.%(msecs)03d] %(module)s %(levelname)s: %(message)s'
+BATCH_FORMAT = '[%(asctime)s.%(msecs)03d] %(threadName)s %(module)s %(levelname)s: %(message)s'
+
 def get_log(name):
     log = logging.getLogger(name)
     h = logging.StreamHandler()
-    formatter = logging.Formatter('[%(asctime)s.%(msecs)03d] %(module)s %(levelname)s: %(message)s',datefmt='%H:%M:%S')
+    formatter = logging.Formatter(FORMAT,datefmt='%H:%M:%S')
     h.setFormatter(formatter)
     log.addHandler(h)    
     return log
@@ -41,5 +44,10 @@ def set_level(level):
     for h in log.handlers:
         h.setLevel(level)
 
+def set_format(fmt):
+    formatter = logging.Formatter(fmt,datefmt='%H:%M:%S')
+    for h in log.handlers:
+        h.setFormatter(formatter)
+
 set_level(logging.INFO)
 
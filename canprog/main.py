@@ -25,75 +25,144 @@
 #
 
 import argparse
-import can
+import collections
+import json
+import os
 import sys
+import threading
+import time
 
 from canprog import __version__, __appname__, __description__
 from canprog import protocols
 from canprog import file
+from canprog import cache
+from canprog import capabilities
+from canprog import checkpoint
+from canprog import metrics
+from canprog import plan as plans
+from canprog import trace
+from canprog import verify as verifiers
 from canprog.logger import log
 
 import canprog.logger
 
-def config_parser():
+DAEMON_PAUSE = 1.0
 
-    parser = argparse.ArgumentParser(prog=__appname__, description=__description__)
-    parser._optionals.title = 'others' 
+def listen_address(value):
+    host, _, port = value.rpartition(':')
+    try:
+        return (host or 'localhost', int(port))
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid address: '+value)
 
-    parser.add_argument('--verbose', action='store_true', default=False, help='enable verbose output')
-    parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__))
-    
-    group = parser.add_argument_group('configuration')
-    group.add_argument('-n', dest='name', action='store', default='slcan0', help='interface name (default: slcan0)')
-    group.add_argument('-i', dest='interface', action='store', choices=('socketcan',), default='socketcan', help='interface type (default: socketcan)')
-    group.add_argument('-f', dest='format', action='store', choices=('hex','bin'), default='hex', help='file format (default: hex)')
-    
-    subparsers = parser.add_subparsers(title='protocols', dest='protocol')
-    
-    subparsers.required = True
+def add_protocol_parser(subparsers, name, help):
+    parser_protocol = subparsers.add_parser(name, help=help)
+    parser_protocol._optionals.title = 'others' 
+    group = parser_protocol.add_argument_group('options')
+    group.add_argument('--read-retries', dest='read_retries', action='store', type=int, default=None, help='retries of a failed read page (default: 2)')
+    group.add_argument('--write-retries', dest='write_retries', action='store', type=int, default=None, help='retries of a failed write page (default: 2)')
+    group.add_argument('--full-handshake', dest='full_handshake', action='store_true', default=False, help='always ask the bootloader for its commands instead of using the cached ones')
+    group.add_argument('--refresh-capabilities', dest='refresh_capabilities', action='store_true', default=False, help='ignore the cached bootloader commands and store them again')
+    group.add_argument('--backoff', dest='backoff', action='store', type=float, default=0.05, help='delay before the first retry in seconds, doubled on each next one (default: 0.05)')
     
-    parser_stm32 = subparsers.add_parser('stm32', help='STM32 ROM bootloader')
-    parser_stm32._optionals.title = 'others' 
+    subparsers_protocol = parser_protocol.add_subparsers(title='commands', dest='command')
+    subparsers_protocol.required = True
     
-    subparsers_stm32 = parser_stm32.add_subparsers(title='commands', dest='command')
-    subparsers_stm32.required = True
-    
-    parser_command = subparsers_stm32.add_parser('write', help='write file to target memory')
+    parser_command = subparsers_protocol.add_parser('write', help='write file to target memory')
     parser_command._optionals.title = 'others' 
     group = parser_command.add_argument_group('options')
     group.add_argument('-e', dest='erase', action='store_true', default=False, help='erase memory before write')
-    group.add_argument('-P', dest='pages', action='store', type=lambda x: int(x,0), default=[], nargs='+', help='list of pages to erase (default: all)')
+    group.add_argument('-m', dest='mass_erase', action='store_true', default=False, help='erase whole memory before write')
+    group.add_argument('-P', dest='pages', action='store', type=lambda x: int(x,0), default=[], nargs='+', help='list of pages to erase (default: pages covered by the image)')
     group.add_argument('-v', dest='verify', action='store_true', default=False, help='verify memory after write')
+    group.add_argument('-V', dest='verify_mode', action='store', choices=('full','sample'), default='full', help='verify method: full readback or random sampled pages (default: full)')
     group.add_argument('-g', dest='go', action='store_true', default=False, help='start application after write')
     group.add_argument('-a', dest='address', action='store', type=lambda x: int(x,0), default=0x08000000, help='start memory address (default: 0x08000000)')
+    group.add_argument('-d', dest='delta', action='store', choices=('read','cache'), default=None, help='erase and write only changed sectors, compared with target memory or with the image last written to this target with -d cache')
+    group.add_argument('-r', '--resume', dest='resume', action='store_true', default=False, help='continue an interrupted write of the same image to the same target')
+    group.add_argument('--fast', dest='fast', action='store', type=int, nargs='?', const=1000000, default=None, help='switch the target and the bus to a faster bitrate for the transfer and back after it (default: 1000000)')
+    group.add_argument('-w', '--window', dest='window', action='store', type=int, default=1, help='data frames in flight per page (default: 1)')
+    group = parser_command.add_argument_group('arguments')    
+    group.add_argument('input', action='store', help='input filename or plan made by compile')
+    
+    parser_command = subparsers_protocol.add_parser('compile', help='compile file to a write plan that write accepts as input')
+    parser_command._optionals.title = 'others' 
+    group = parser_command.add_argument_group('options')
+    group.add_argument('-a', dest='address', action='store', type=lambda x: int(x,0), default=0x08000000, help='start memory address (default: 0x08000000)')
     group = parser_command.add_argument_group('arguments')    
     group.add_argument('input', action='store', help='input filename')
+    group.add_argument('output', action='store', help='output plan filename')
     
-    parser_command = subparsers_stm32.add_parser('read', help='read target memory to file')
+    parser_command = subparsers_protocol.add_parser('read', help='read target memory to file')
     parser_command._optionals.title = 'others' 
     group = parser_command.add_argument_group('options')
     group.add_argument('-a', dest='address', action='store', type=lambda x: int(x,0), default=0x08000000, help='start memory address (default: 0x08000000)')
     group.add_argument('-s', dest='size', action='store', type=lambda x: int(x,0), default=0x8000, help='data size to read (default: 0x8000)')
+    group.add_argument('--fast', dest='fast', action='store', type=int, nargs='?', const=1000000, default=None, help='switch the target and the bus to a faster bitrate for the transfer and back after it (default: 1000000)')
+    group.add_argument('-p', dest='pipeline', action='store_true', default=False, help='request the next page before the current one is acknowledged')
+    group.add_argument('-r', '--resume', dest='resume', action='store_true', default=False, help='continue an interrupted read from the last page in the output file')
     group = parser_command.add_argument_group('arguments')    
     group.add_argument('output', action='store', help='output filename')
 
-    parser_command = subparsers_stm32.add_parser('erase', help='erase target memory')
+    parser_command = subparsers_protocol.add_parser('erase', help='erase target memory')
     parser_command._optionals.title = 'others' 
     group = parser_command.add_argument_group('options')
     group.add_argument('-P', dest='pages', action='store', type=lambda x: int(x,0), default=[], nargs='+', help='list of pages to erase (default: all)')
     
-    parser_command = subparsers_stm32.add_parser('go', help='start program application')
+    parser_command = subparsers_protocol.add_parser('go', help='start program application')
     parser_command._optionals.title = 'others' 
     group = parser_command.add_argument_group('options')
     group.add_argument('-a', dest='address', action='store', type=lambda x: int(x,0), default=0x08000000, help='start memory address (default: 0x08000000)')
     
-    parser_command = subparsers_stm32.add_parser('lock', help='enable readout protection')
-    parser_command = subparsers_stm32.add_parser('unlock', help='disable readout protection')
+    parser_command = subparsers_protocol.add_parser('lock', help='enable readout protection')
+    parser_command = subparsers_protocol.add_parser('unlock', help='disable readout protection')
 
-    parser_command = subparsers_stm32.add_parser('speed', help='change the can baud rate the boot rom uses')
+    parser_command = subparsers_protocol.add_parser('speed', help='change the can baud rate the boot rom uses')
     group = parser_command.add_argument_group('arguments')
     group.add_argument('bps', action='store', type=lambda x: int(x), help='new baud rate')
 
+def add_configuration(group):
+    group.add_argument('-n', dest='names', action='append', default=None, help='interface name, repeat to flash several targets at once (default: slcan0)')
+    group.add_argument('-i', dest='interface', action='store', choices=('socketcan',), default='socketcan', help='interface type (default: socketcan)')
+    group.add_argument('-f', dest='format', action='store', choices=('hex','bin'), default='hex', help='file format (default: hex)')
+    group.add_argument('-t', '--trace', dest='trace', action='store', default=None, help='save every sent and received frame with its timing to a file')
+    group.add_argument('--trace-format', dest='trace_format', action='store', choices=('candump','chrome'), default=None, help='trace file format: candump log or Chrome trace JSON (default: chrome for .json files, else candump)')
+    group.add_argument('--metrics-file', dest='metrics_file', action='store', default=None, help='write metrics in Prometheus text format to a file after every run, for the node exporter textfile collector')
+    group.add_argument('--metrics-listen', dest='metrics_listen', action='store', type=listen_address, default=None, help='serve metrics over HTTP on [HOST:]PORT (default host: localhost)')
+    group.add_argument('-D', '--daemon', dest='daemon', action='store_true', default=False, help='repeat the command for every new target until interrupted, waiting for the current one to be removed')
+
+def requested_protocol(args):
+    parser = argparse.ArgumentParser(prog=__appname__, add_help=False)
+    add_configuration(parser)
+    parser.add_argument('protocol', nargs='?')
+    parser.add_argument('rest', nargs=argparse.REMAINDER)
+    params, unknown = parser.parse_known_args(args)
+    return params.protocol
+
+def config_parser(args=None):
+
+    parser = argparse.ArgumentParser(prog=__appname__, description=__description__)
+    parser._optionals.title = 'others' 
+
+    parser.add_argument('--verbose', action='store_true', default=False, help='enable verbose output')
+    parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=__version__))
+    
+    add_configuration(parser.add_argument_group('configuration'))
+    
+    subparsers = parser.add_subparsers(title='protocols', dest='protocol')
+    
+    subparsers.required = True
+    
+    for name, help in protocols.DESCRIPTIONS.items():
+        add_protocol_parser(subparsers, name, help)
+    
+    if args != None:
+        name = requested_protocol(args)
+        if name != None and name not in protocols.DESCRIPTIONS:
+            help = protocols.get_plugin_description(name)
+            if help != None:
+                add_protocol_parser(subparsers, name, help)
+
     """
     parser_simple = subparsers.add_parser('simple', help='Simple bootloader')
     parser_simple._optionals.title = 'others' 
@@ -112,7 +181,8 @@ def config_parser():
 def connect(protocol):
     try:
         log.info('Connecting target')
-        protocol.connect()          
+        with metrics.timer('connect'):
+            protocol.connect()
         log.info('Connected')
     except TimeoutError as e:
         raise ConnectionError('Connecting error: '+str(e))
@@ -120,15 +190,22 @@ def connect(protocol):
 def disconnect(protocol):
     try:
         log.info('Disconnecting target')
-        protocol.disconnect()
-        log.info('Disconnected')
+        with metrics.timer('disconnect'):
+            protocol.disconnect()
+        if protocol.retries > 0:
+            log.info('Disconnected (retries: {retries}, re-sent: {size} bytes)'.format(retries=protocol.retries, size=protocol.resent_bytes))
+        else:
+            log.info('Disconnected')
+        for aid, count in sorted(protocol.inbox_dropped.items()):
+            log.warning('Dropped {count} unmatched frames with ID 0x{aid:03X}'.format(count=count, aid=aid))
     except TimeoutError as e:
         raise ConnectionError('Disconnecting error: '+str(e))
     
 def go(protocol, address):
     try:
         log.info('Starting application')
-        protocol.go(address)
+        with metrics.timer('go'):
+            protocol.go(address)
         log.info('Successful')
     except TimeoutError as e:
         raise ConnectionError('Starting error: '+str(e))
@@ -136,47 +213,218 @@ def go(protocol, address):
 def erase(protocol, pages):
     try:
         log.info('Erasing memory. Please wait...')
-        protocol.erase(pages)
+        with metrics.timer('erase'):
+            protocol.erase(pages)
         log.info('Successful')
     except TimeoutError as e:
         raise ConnectionError('Erasing error: '+str(e))
 
-def read(protocol, address, size):
+def read(protocol, address, size, sink=None):
     try:
         log.info('Reading memory at 0x{address:08X}:{size}'.format(address=address, size=size))
-        d = protocol.read(address, size)
+        with metrics.timer('read'):
+            d = protocol.read(address, size, sink)
         log.info('Successful')
         return d
     except TimeoutError as e:
         raise ConnectionError('Reading error: '+str(e))
 
-def write(protocol, address, data):
+def read_to_file(protocol, address, size, filename, fmt, resume=False):
+    sink = file.FileSink(filename, fmt, address, resume)
+    try:
+        done = sink.address - address
+        if done > 0:
+            log.info('Resuming at 0x{address:08X}, {done} bytes already read'.format(address=sink.address, done=done))
+        if done < size:
+            read(protocol, sink.address, size - done, sink)
+    finally:
+        sink.close()
+
+def write(protocol, address, data, progress=None):
     try:
         log.info('Writing memory at 0x{address:08X}:{size}'.format(address=address, size=len(data)))
-        protocol.write(address, data)
+        with metrics.timer('write'):
+            protocol.write(address, data, progress)
+        log.info('Successful')
+    except TimeoutError as e:
+        raise ConnectionError('Writing error: '+str(e))
+
+def write_plan(protocol, address, pages, progress=None):
+    try:
+        log.info('Writing memory at 0x{address:08X}:{size}'.format(address=address, size=sum(page.size for page in pages)))
+        with metrics.timer('write'):
+            protocol.write_plan(pages, progress)
         log.info('Successful')
     except TimeoutError as e:
         raise ConnectionError('Writing error: '+str(e))
 
-def verify(protocol, address, data):
+def compile_image(protocol, filename, fmt, address, output):
+    datafile = file.FileManager()
+    datafile.load(filename, fmt, address)
+    try:
+        compiled = plans.compile_plan(datafile, protocol)
+    except NotImplementedError:
+        raise ValueError('Protocol {} does not support write plans'.format(protocol))
+    try:
+        compiled.save(output)
+    except OSError as e:
+        raise ValueError('Saving plan error: '+str(e))
+    pages = sum(len(pages) for address, data, pages in compiled.segments)
+    log.info('Compiled {pages} pages in {segments} segments to {output}'.format(pages=pages, segments=len(compiled.segments), output=output))
+
+def verify(protocol, address, data, verifier=None):
+    if verifier == None:
+        verifier = verifiers.FullVerify()
     try:
         log.info('Verifying memory at 0x{address:08X}:{size}'.format(address=address, size=len(data)))
-        data_readed = protocol.read(address, len(data))
-        if len(data_readed) != len(data):
-            raise ValueError('Size mismatch {} != {}'.format(len(data_readed),len(data)))
-        for (a, b), i in zip(zip(data_readed, data), range(address, address+len(data))):
-            if a != b:
-                raise ValueError('Mismatch at 0x{address:08X} 0x{:02X}!=0x{:02X}'.format(a, b, address=i))
+        with metrics.timer('verify'):
+            verifier.verify(protocol, address, data)
         log.info('Successful')
     except TimeoutError as e:
         raise ConnectionError('Verifying error: '+str(e))
     except ValueError as e:
         raise ConnectionError('Verifying error: '+str(e))
     
+def get_image_cache_path(protocol, name):
+    return cache.get_cache_path('image-{name}-{chip}.hex'.format(name=name, chip=protocol.chip_id))
+
+def load_image_cache(protocol, name):
+    if protocol.chip_id == None:
+        return None
+    path = get_image_cache_path(protocol, name)
+    if not os.path.exists(path):
+        return None
+    cached = file.FileManager()
+    cached.load(path, 'hex')
+    return cached
+
+def save_image_cache(protocol, name, datafile):
+    if protocol.chip_id == None:
+        return
+    try:
+        datafile.save(get_image_cache_path(protocol, name), 'hex')
+    except OSError as e:
+        log.warning('Cannot save image cache: '+str(e))
+
+def remove_image_cache(protocol, name):
+    if protocol.chip_id == None:
+        return
+    try:
+        os.remove(get_image_cache_path(protocol, name))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.warning('Cannot remove image cache: '+str(e))
+
+def split_sectors(sectors, segments):
+    chunks = collections.OrderedDict()
+    for address, data in segments:
+        end = address + len(data)
+        for number, start, size in sectors:
+            lo = max(address, start)
+            hi = min(end, start + size)
+            if lo < hi:
+                chunks.setdefault(number, []).append((lo, data[lo-address:hi-address],))
+    return chunks
+
+def image_sectors(protocol, segments):
+    try:
+        sectors = protocol.sectors()
+    except NotImplementedError:
+        sectors = []
+    
+    chunks = split_sectors(sectors, segments)
+    
+    total = sum(len(data) for address, data in segments)
+    if sum(len(data) for parts in chunks.values() for address, data in parts) != total:
+        return None
+    if len(chunks) > 0 and protocol.MAX_ERASE_PAGE != None and max(chunks) > protocol.MAX_ERASE_PAGE:
+        return None
+    return chunks
+
+def erase_image(protocol, segments):
+    chunks = image_sectors(protocol, segments)
+    if chunks == None:
+        log.warning('Unknown flash layout for this target, erasing whole memory')
+        erase(protocol, [])
+        return
+    if len(chunks) == 0:
+        log.info('Image is empty, nothing to erase')
+        return
+    erase(protocol, list(chunks))
+
+def delta_write(protocol, datafile, cached=None):
+    segments = list(datafile.get_segments())
+    chunks = image_sectors(protocol, segments)
+    if chunks == None:
+        log.warning('Unknown flash layout for this target, writing whole image')
+        return False
+    total = sum(len(data) for address, data in segments)
+    
+    changed = []
+    skipped = 0
+    for number, parts in chunks.items():
+        for address, data in parts:
+            if cached != None:
+                current = cached.get_data(address, len(data))
+            else:
+                current = read(protocol, address, len(data))
+            if current == None or bytes(current) != bytes(data):
+                changed.append(number)
+                break
+        else:
+            skipped += sum(len(data) for address, data in parts)
+    
+    if len(changed) > 0:
+        erase(protocol, changed)
+        for number in changed:
+            for address, data in chunks[number]:
+                write(protocol, address, data)
+    
+    log.info('Changed sectors: {changed}/{total}, skipped {skipped} of {size} bytes'.format(changed=len(changed), total=len(chunks), skipped=skipped, size=total))
+    return True
+
+def written_ahead(protocol, address, data, done):
+    size = min(checkpoint.SAVE_PAGES * 256, len(data) - done)
+    if size <= 0:
+        return done
+    current = read(protocol, address + done, size)
+    for i in range(0, size, 256):
+        if bytes(current[i:i+256]) != bytes(data[done+i:done+i+256]):
+            return done + i
+    return done + size
+
+def resume_write(protocol, datafile, state):
+    if not state.load():
+        log.warning('No checkpoint for this image and target, writing whole image')
+        return False
+    
+    segments = list(datafile.get_segments())
+    resume_at = {}
+    for address, data in segments:
+        done = state.written(address)
+        if done > 0:
+            last = ((done - 1) // 256) * 256
+            current = read(protocol, address + last, done - last)
+            if bytes(current) != bytes(data[last:done]):
+                log.warning('Last written page at 0x{:08X} does not match, writing whole image'.format(address + last))
+                return False
+            done = written_ahead(protocol, address, data, done)
+        resume_at[address] = done
+    
+    for address, data in segments:
+        done = resume_at[address]
+        if done < len(data):
+            if done > 0:
+                log.info('Resuming at 0x{address:08X}, {done} bytes already written'.format(address=address+done, done=done))
+            write(protocol, address + done, data[done:], state.progress(address))
+    return True
+
 def lock(protocol):
     try:
         log.info('Enabling readout protection')
-        protocol.lock()          
+        with metrics.timer('lock'):
+            protocol.lock()
         log.info('Successful')
     except TimeoutError as e:
         raise ConnectionError('Enabling error: '+str(e))
@@ -184,7 +432,8 @@ def lock(protocol):
 def unlock(protocol):
     try:
         log.info('Disabling readout protection')
-        protocol.unlock()          
+        with metrics.timer('unlock'):
+            protocol.unlock()
         log.info('Successful')
     except TimeoutError as e:
         raise ConnectionError('Disabling error: '+str(e))                      
@@ -192,70 +441,387 @@ def unlock(protocol):
 def speed(protocol, bps):
     try:
         log.info('Setting speed to %d bps' % (bps,))
-        protocol.speed(bps)
-        log.info('Command sent')
+        with metrics.timer('speed'):
+            protocol.speed(bps)
+        log.info('Successful')
     except TimeoutError as e:
         raise ConnectionError('Writing error: '+str(e))
 
-def main():
+class ImagePreparer(object):
     
-    parser = config_parser()
+    def __init__(self, filename, fmt, address):
+        import concurrent.futures
+        self._plan = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._datafile = self._executor.submit(self._load, filename, fmt, address)
+        self._digest = self._executor.submit(self._hash)
+        self._executor.shutdown(wait=False)
     
-    params = parser.parse_args()
+    def _load(self, filename, fmt, address):
+        if plans.is_plan(filename):
+            self._plan = plans.load(filename)
+            return self._plan.image
+        datafile = file.FileManager()
+        datafile.load(filename, fmt, address)
+        return datafile
     
-    if params.verbose:
-        canprog.logger.set_level(canprog.logger.logging.DEBUG)
+    def _hash(self):
+        datafile = self._datafile.result()
+        if self._plan != None:
+            return self._plan.digest
+        return checkpoint.image_hash(datafile.get_segments())
     
-    if params.interface == 'socketcan':
-        iface = can.interface.Bus(channel=params.name, bustype='socketcan_native')
+    def datafile(self):
+        return self._datafile.result()
     
-    datafile = file.FileManager()
+    def plan(self):
+        self._datafile.result()
+        return self._plan
+    
+    def digest(self):
+        return self._digest.result()
+
+def get_bitrate(interface, name):
+    if interface != 'socketcan':
+        return None
+    import subprocess
+    try:
+        result = subprocess.run(['ip', '-details', '-json', 'link', 'show', 'dev', name], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        return json.loads(result.stdout.decode())[0]['linkinfo']['info_data']['bittiming']['bitrate']
+    except (OSError, subprocess.CalledProcessError, ValueError, LookupError, TypeError):
+        return None
+
+def set_bitrate(interface, name, bitrate):
+    if interface != 'socketcan':
+        raise NotImplementedError('unknown interface type')
+    import subprocess
+    def ip_link(*args):
+        try:
+            subprocess.run(['ip', 'link', 'set', name] + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+        except subprocess.CalledProcessError as e:
+            raise OSError('Setting bitrate of {name} error: {error}'.format(name=name, error=e.stderr.decode().strip()))
+    ip_link('down')
+    try:
+        ip_link('type', 'can', 'bitrate', str(bitrate))
+    finally:
+        ip_link('up')
+
+def open_bus(interface, name, bitrate=None, fd=False):
+    import can
+    if interface == 'socketcan':
+        if bitrate != None:
+            set_bitrate(interface, name, bitrate)
+        return can.interface.Bus(channel=name, interface='socketcan', fd=fd)
+    raise NotImplementedError('unknown interface type')
+
+def uses_fd(params):
+    return protocols.get_protocol_class_by_name(params.protocol).FD
+
+def switch_bus(protocol, interface, name, bitrate, sync=True):
+    protocol.iface.shutdown()
+    try:
+        protocol.set_iface(open_bus(interface, name, bitrate, protocol.FD))
+    except OSError as e:
+        log.warning(str(e))
+        return False
+    if not sync:
+        return True
+    try:
+        protocol.sync()
+        return True
+    except (TimeoutError, ConnectionError):
+        return False
+
+def upshift(protocol, interface, name, bitrate):
+    current = get_bitrate(interface, name)
+    if current == None:
+        log.warning('Unknown bitrate of {name}, staying at the current rate'.format(name=name))
+        return None
+    if current >= bitrate:
+        log.info('Bus already at {current} bps'.format(current=current))
+        return None
     
+    log.info('Switching to {bitrate} bps'.format(bitrate=bitrate))
+    try:
+        protocol.speed(bitrate)
+    except (TimeoutError, ConnectionError, NotImplementedError) as e:
+        log.warning('Speed change refused: {error}. Staying at {current} bps'.format(error=e, current=current))
+        return None
+    if switch_bus(protocol, interface, name, bitrate):
+        log.info('Switched to {bitrate} bps'.format(bitrate=bitrate))
+        return current
+    
+    log.warning('No response at {bitrate} bps, going back to {current} bps'.format(bitrate=bitrate, current=current))
+    if switch_bus(protocol, interface, name, current):
+        return None
+    raise ConnectionError('Target lost after speed change')
+
+def downshift(protocol, interface, name, bitrate, target=True):
+    log.info('Restoring {bitrate} bps'.format(bitrate=bitrate))
+    if target:
+        try:
+            protocol.speed(bitrate)
+        except (TimeoutError, ConnectionError) as e:
+            log.warning('Speed restore refused: '+str(e))
+            return
+    if not switch_bus(protocol, interface, name, bitrate, target):
+        log.warning('No response at {bitrate} bps after restore'.format(bitrate=bitrate))
+
+def run(params, name, iface, image=None, tracer=None):
     protocol_class = protocols.get_protocol_class_by_name(params.protocol)
     protocol = protocol_class(iface)
+    protocol.tracer = tracer
+    if not params.full_handshake:
+        protocol.capabilities = capabilities.get_cache(params.protocol, params.refresh_capabilities)
+    if params.read_retries != None:
+        protocol.read_retry.retries = params.read_retries
+    if params.write_retries != None:
+        protocol.write_retry.retries = params.write_retries
+    protocol.read_retry.backoff = params.backoff
+    protocol.write_retry.backoff = params.backoff
+    
+    start = time.monotonic()
+    result = 'error'
+    try:
+        execute(params, name, protocol, image)
+        result = 'ok'
+    finally:
+        if protocol.iface is not iface:
+            protocol.iface.shutdown()
+        record_metrics(params, name, protocol, result, time.monotonic() - start)
+
+def record_metrics(params, name, protocol, result, duration):
+    chip = protocol.chip_id or 'unknown'
+    metrics.target_duration.observe(duration, chip=chip, command=params.command, result=result)
+    metrics.bytes_written.inc(protocol.written_bytes, target=name)
+    metrics.bytes_read.inc(protocol.read_bytes, target=name)
+    metrics.retries.inc(protocol.retries, target=name)
+    metrics.timeouts.inc(protocol.timeouts, target=name)
+    metrics.nacks.inc(protocol.nacks, target=name)
+
+def execute(params, name, protocol, image):
+    connect(protocol)
+    
+    original = None
+    if params.command in ('write', 'read') and params.fast != None:
+        original = upshift(protocol, params.interface, name, params.fast)
     
     try:
-        connect(protocol)
-        
         if params.command == 'go':
             go(protocol, params.address)
         elif params.command == 'erase':
+            remove_image_cache(protocol, name)
             erase(protocol, params.pages)
         elif params.command == 'write':
-            if params.erase:
-                erase(protocol, params.pages)
+            protocol.write_window = params.window
+            
+            cached = None
+            if params.delta == 'cache' and not params.resume:
+                cached = load_image_cache(protocol, name)
+                if cached == None:
+                    log.warning('No cached image for this target, comparing with target memory')
+            remove_image_cache(protocol, name)
+        
+            state = None
+            written = False
+            if params.resume:
+                state = checkpoint.Checkpoint(name, protocol.chip_id, image.digest())
+                written = resume_write(protocol, image.datafile(), state)
+            elif params.delta != None:
+                written = delta_write(protocol, image.datafile(), cached)
+        
+            if not written:
+                if params.mass_erase or (params.erase and len(params.pages) > 0):
+                    erase(protocol, params.pages)
+                elif params.erase or (params.delta != None and not params.resume):
+                    erase_image(protocol, list(image.datafile().get_segments()))
+            
+                state = checkpoint.Checkpoint(name, protocol.chip_id, image.digest())
+                state.clear()
+                compiled = image.plan()
+                if compiled != None and compiled.protocol != params.protocol:
+                    log.warning('Plan compiled for {plan}, writing its image with {protocol}'.format(plan=compiled.protocol, protocol=params.protocol))
+                    compiled = None
+                if compiled != None:
+                    for address, data, pages in compiled.segments:
+                        write_plan(protocol, address, pages, state.progress(address))
+                else:
+                    for address, data in image.datafile().get_segments():
+                        write(protocol, address, data, state.progress(address))
+        
+            if state == None:
+                state = checkpoint.Checkpoint(name, protocol.chip_id, image.digest())
+            state.remove()
+            datafile = image.datafile()
             
-            datafile.load(params.input, params.format, params.address)
-            for address, data in datafile.get_segments():
-                write(protocol, address, data)
-                
             if params.verify:
+                verifier = verifiers.get_verifier_by_name(params.verify_mode)
                 for address, data in datafile.get_segments():
-                    verify(protocol, address, data)
-                        
+                    verify(protocol, address, data, verifier)
+                    
             if params.go:
                 go(protocol, params.address)
+            
+            if params.delta == 'cache':
+                save_image_cache(protocol, name, datafile)
         elif params.command == 'read':
-            data = read(protocol, params.address, params.size)            
-            datafile.set_segment(params.address, data)
-            datafile.save(params.output, params.format)    
+            protocol.read_pipeline = params.pipeline
+            read_to_file(protocol, params.address, params.size, params.output, params.format, params.resume)
         elif params.command == 'lock':
             lock(protocol)
         elif params.command == 'unlock':
+            remove_image_cache(protocol, name)
             unlock(protocol)            
         elif params.command == 'speed':
             speed(protocol, params.bps)
         else:
             log.info('Nothing to do...')
+    finally:
+        if original != None:
+            downshift(protocol, params.interface, name, original, not (params.command == 'write' and params.go))
+    
+    disconnect(protocol)
+
+def run_target(params, name, image, tracer, results):
+    start = time.monotonic()
+    try:
+        iface = open_bus(params.interface, name, fd=uses_fd(params))
+        try:
+            run(params, name, iface, image, tracer)
+            result = 'OK'
+        finally:
+            iface.shutdown()
+    except Exception as e:
+        log.error(e)
+        result = 'FAILED: '+str(e)
+    results[name] = (time.monotonic() - start, result,)
+
+def batch(params, image, tracers):
+    if params.command == 'read':
+        raise ValueError('Read command is not supported with multiple interfaces')
+    
+    canprog.logger.set_format(canprog.logger.BATCH_FORMAT)
+    
+    results = {}
+    threads = []
+    for name in params.names:
+        thread = threading.Thread(target=run_target, name=name, args=(params, name, image, tracers.get(name), results,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    
+    log.info('Summary:')
+    for name in params.names:
+        duration, result = results[name]
+        log.info('{name:<16} {duration:8.2f}s  {result}'.format(name=name, duration=duration, result=result))
+    
+    return all(result == 'OK' for duration, result in results.values())
+
+def session(params, image, tracers):
+    if len(params.names) > 1:
+        return batch(params, image, tracers)
+    name = params.names[0]
+    iface = open_bus(params.interface, name, fd=uses_fd(params))
+    try:
+        run(params, name, iface, image, tracers.get(name))
+    finally:
+        iface.shutdown()
+    return True
+
+def target_present(params, name):
+    iface = open_bus(params.interface, name, fd=uses_fd(params))
+    try:
+        protocol = protocols.get_protocol_class_by_name(params.protocol)(iface)
+        return protocol.ping()
+    except NotImplementedError:
+        raise ValueError('Protocol {} cannot detect targets, daemon mode is not supported'.format(params.protocol))
+    finally:
+        iface.shutdown()
+
+def wait_for_targets(params, present):
+    waiting = list(params.names)
+    while len(waiting) > 0:
+        waiting = [name for name in waiting if target_present(params, name) != present]
+        if len(waiting) > 0:
+            time.sleep(DAEMON_PAUSE)
+
+def save_metrics(filename):
+    try:
+        metrics.write_textfile(filename)
+    except OSError as e:
+        log.error('Saving metrics error: '+str(e))
+
+def save_trace(filename, fmt, tracers):
+    try:
+        trace.save(filename, fmt, tracers)
+        log.info('Trace of {count} frames saved to {filename}'.format(count=sum(len(tracer.events) for tracer in tracers), filename=filename))
+    except OSError as e:
+        log.error('Saving trace error: '+str(e))
+
+def main():
+    
+    parser = config_parser(sys.argv[1:])
+    
+    params = parser.parse_args()
+    
+    if params.verbose:
+        canprog.logger.set_level(canprog.logger.logging.DEBUG)
+    
+    if params.names == None:
+        params.names = ['slcan0']
+    
+    image = None
+    tracers = {}
+    if params.trace != None:
+        tracers = {name: trace.Tracer(name) for name in params.names}
+    
+    try:
+        if params.command == 'compile':
+            compile_image(params.protocol, params.input, params.format, params.address, params.output)
+            sys.exit(0)
         
-        disconnect(protocol)
-        sys.exit(0)
+        if params.command == 'write':
+            if params.window < 1:
+                raise ValueError('Window must be at least 1')
+            image = ImagePreparer(params.input, params.format, params.address)
+        
+        if params.metrics_listen != None:
+            host, port = params.metrics_listen
+            try:
+                metrics.serve(host, port)
+            except OSError as e:
+                raise ValueError('Serving metrics error: '+str(e))
+            log.info('Serving metrics on http://{host}:{port}/metrics'.format(host=host, port=port))
+        
+        while True:
+            try:
+                ok = session(params, image, tracers)
+            except ConnectionError as e:
+                if not params.daemon:
+                    raise
+                log.error(e)
+                ok = False
+            finally:
+                if params.metrics_file != None:
+                    save_metrics(params.metrics_file)
+            if not params.daemon:
+                if ok:
+                    sys.exit(0)
+                break
+            log.info('Waiting for the next target')
+            wait_for_targets(params, False)
+            wait_for_targets(params, True)
     except ValueError as e:
         log.error(e)
     except ConnectionError as e:
         log.error(e)
+    except KeyboardInterrupt:
+        log.info('Interrupted')
+    finally:
+        if params.trace != None:
+            save_trace(params.trace, params.trace_format, [tracers[name] for name in params.names])
+    sys.exit(1)
 
 if __name__ == '__main__':
     main()
-    sys.exit(1)
-    
\ No newline at end of file
@@ -0,0 +1,164 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import os
+import threading
+import time
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+    
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[k]) for k in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(self.name, _format_labels(self.labels, key), _format_value(value)))
+        return lines
+
+class Histogram(object):
+    
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels[k]) for k in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+    
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labels, key, (('le', _format_value(bound)),)), count))
+                lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labels, key), repr(total)))
+                lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labels, key), counts[-1]))
+        return lines
+
+class Registry(object):
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def expose(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+bytes_written = REGISTRY.register(Counter('canprog_written_bytes_total', 'Bytes written to target memory.', ('target',)))
+bytes_read = REGISTRY.register(Counter('canprog_read_bytes_total', 'Bytes read from target memory, verify included.', ('target',)))
+retries = REGISTRY.register(Counter('canprog_retries_total', 'Pages sent again after a failure.', ('target',)))
+timeouts = REGISTRY.register(Counter('canprog_timeouts_total', 'Frames not received in time.', ('target',)))
+nacks = REGISTRY.register(Counter('canprog_nacks_total', 'Commands not acknowledged by the target.', ('target',)))
+command_duration = REGISTRY.register(Histogram('canprog_command_duration_seconds', 'Duration of a single bootloader operation.', ('command', 'result')))
+target_duration = REGISTRY.register(Histogram('canprog_target_duration_seconds', 'Duration of a whole session with one target.', ('chip', 'command', 'result')))
+
+class timer(object):
+    
+    def __init__(self, command):
+        self.command = command
+    
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type == None:
+            result = 'ok'
+        elif issubclass(exc_type, TimeoutError):
+            result = 'timeout'
+        else:
+            result = 'error'
+        command_duration.observe(time.monotonic() - self._start, command=self.command, result=result)
+        return False
+
+def write_textfile(filename, registry=REGISTRY):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(registry.expose())
+    os.replace(tmp, filename)
+
+def serve(address, port, registry=REGISTRY):
+    import http.server
+    
+    class Handler(http.server.BaseHTTPRequestHandler):
+        
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = http.server.ThreadingHTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,144 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import struct
+import zlib
+
+from canprog import file
+from canprog import protocols
+from canprog.checkpoint import image_hash
+
+MAGIC = b'CPPLAN'
+VERSION = 1
+PAGE_SIZE = 256
+
+HEADER = struct.Struct('>6sB16s32sI')
+SEGMENT = struct.Struct('>III')
+PAGE = struct.Struct('>5sI')
+
+class PlanPage(object):
+    '''
+    One WRITE_MEMORY page: the encoded command payload, the page data and
+    its CRC32. The protocol keeps the frames it builds from a page in
+    frames, so boards after the first one reuse them.
+    '''
+    
+    def __init__(self, address, header, crc, data):
+        self.address = address
+        self.header = header
+        self.crc = crc
+        self.data = data
+        self.frames = None
+    
+    @property
+    def size(self):
+        return len(self.data)
+
+class Plan(object):
+    
+    def __init__(self, protocol='stm32'):
+        self.protocol = protocol
+        self.digest = None
+        self.segments = []
+        self.image = file.FileManager()
+    
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.protocol.encode('ascii'), bytes.fromhex(self.digest), len(self.segments)))
+            for address, data, pages in self.segments:
+                f.write(SEGMENT.pack(address, len(data), len(pages)))
+                for page in pages:
+                    f.write(PAGE.pack(page.header, page.crc))
+                f.write(data)
+
+def get_encoder(protocol):
+    return protocols.get_protocol_class_by_name(protocol).encode_page
+
+def compile_plan(datafile, protocol='stm32'):
+    encode_page = get_encoder(protocol)
+    plan = Plan(protocol)
+    segments = list(datafile.get_segments())
+    plan.digest = image_hash(segments)
+    for address, data in segments:
+        data = bytes(data)
+        view = memoryview(data)
+        pages = []
+        for i in range(0, len(data), PAGE_SIZE):
+            page = view[i:i+PAGE_SIZE]
+            pages.append(PlanPage(address+i, encode_page(address+i, len(page)), zlib.crc32(page), page))
+        plan.segments.append((address, view, pages,))
+        plan.image.set_segment(address, data)
+    return plan
+
+def is_plan(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def load(filename):
+    with open(filename, 'rb') as f:
+        content = memoryview(f.read())
+    
+    if len(content) < HEADER.size:
+        raise ValueError('Truncated plan file')
+    magic, version, protocol, digest, count = HEADER.unpack_from(content)
+    if magic != MAGIC:
+        raise ValueError('Not a plan file')
+    if version != VERSION:
+        raise ValueError('Unsupported plan version {}'.format(version))
+    
+    plan = Plan(protocol.rstrip(b'\0').decode('ascii'))
+    try:
+        encode_page = get_encoder(plan.protocol)
+    except NotImplementedError:
+        raise ValueError('Protocol {} does not support write plans'.format(plan.protocol))
+    plan.digest = digest.hex()
+    offset = HEADER.size
+    try:
+        for n in range(count):
+            address, size, page_count = SEGMENT.unpack_from(content, offset)
+            offset += SEGMENT.size
+            if page_count != (size + PAGE_SIZE - 1) // PAGE_SIZE:
+                raise ValueError('Corrupted plan segment at 0x{:08X}'.format(address))
+            entries = [PAGE.unpack_from(content, offset + i * PAGE.size) for i in range(page_count)]
+            offset += page_count * PAGE.size
+            data = content[offset:offset+size]
+            if len(data) != size:
+                raise ValueError('Truncated plan file')
+            offset += size
+            
+            pages = []
+            for i, (header, crc) in enumerate(entries):
+                page = data[i*PAGE_SIZE:(i+1)*PAGE_SIZE]
+                page_address = address + i * PAGE_SIZE
+                if header != encode_page(page_address, len(page)) or zlib.crc32(page) != crc:
+                    raise ValueError('Corrupted plan page at 0x{:08X}'.format(page_address))
+                pages.append(PlanPage(page_address, header, crc, page))
+            plan.segments.append((address, data, pages,))
+            plan.image.set_segment(address, data)
+    except struct.error:
+        raise ValueError('Truncated plan file')
+    return plan
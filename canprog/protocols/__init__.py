@@ -22,12 +22,64 @@
 # THE SOFTWARE.
 #
 
-from .abstract import AbstractProtocol
+import importlib
 
-from . import stm32
+ENTRY_POINT_GROUP = 'canprog.protocols'
+
+PROTOCOLS = {
+    'stm32': 'canprog.protocols.stm32:STM32Protocol',
+    'stm32fd': 'canprog.protocols.stm32:STM32FDProtocol',
+}
+
+DESCRIPTIONS = {
+    'stm32': 'STM32 ROM bootloader',
+    'stm32fd': 'STM32 FDCAN ROM bootloader, 64-byte CAN FD frames',
+}
+
+_LAZY = {
+    'AbstractProtocol': 'canprog.protocols.abstract:AbstractProtocol',
+    'AsyncAbstractProtocol': 'canprog.protocols.abstract:AsyncAbstractProtocol',
+}
+
+def _load(path):
+    module_name, _, attr = path.partition(':')
+    module = importlib.import_module(module_name)
+    return getattr(module, attr) if attr else module
+
+def __getattr__(name):
+    if name in _LAZY:
+        return _load(_LAZY[name])
+    module_name = '{}.{}'.format(__name__, name)
+    try:
+        return importlib.import_module(module_name)
+    except ModuleNotFoundError as e:
+        if e.name != module_name:
+            raise
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def _entry_points():
+    from importlib import metadata
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=ENTRY_POINT_GROUP))
+    return list(entry_points.get(ENTRY_POINT_GROUP, []))
+
+def _entry_point(name):
+    for ep in _entry_points():
+        if ep.name == name:
+            return ep.load()
+    return None
+
+def get_plugin_description(name):
+    for ep in _entry_points():
+        if ep.name == name:
+            return 'plugin protocol {}'.format(ep.value)
+    return None
 
 def get_protocol_class_by_name(name):
-    if name == 'stm32':
-        return stm32.STM32Protocol
-    else:
+    if name in PROTOCOLS:
+        return _load(PROTOCOLS[name])
+    protocol_class = _entry_point(name)
+    if protocol_class == None:
         raise NotImplementedError('unknown protocol type')
+    return protocol_class
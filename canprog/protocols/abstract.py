@@ -22,16 +22,26 @@
 # THE SOFTWARE.
 #
 
+import asyncio
 import can 
-import sys
+import collections
+import logging
 import time
 
 from canprog.logger import log
 
-if 'win' in sys.platform.lower():
-    current_time = time.clock
-else:
-    current_time = time.time
+current_time = time.monotonic
+
+class RetryPolicy(object):
+    
+    def __init__(self, retries=0, backoff=0.05, factor=2.0, max_backoff=1.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+    
+    def delay(self, attempt):
+        return min(self.max_backoff, self.backoff * (self.factor ** (attempt - 1)))
     
 def canframe_to_string(msg):
 
@@ -66,39 +76,138 @@ class AbstractProtocol(object):
     classdocs
     '''
     RECV_TIMEOUT = 1.0
+    INBOX_SIZE = 64
+    FD = False
+    REPLY_IDS = {}
+    MAX_ERASE_PAGE = None
 
     def __init__(self, iface):
         if not isinstance(iface, can.BusABC):
             raise TypeError('canbus interface not compatible')
         self._iface = iface
+        self._chip_id = None
+        self._inbox = {}
+        self._inbox_dropped = collections.Counter()
+        self.retries = 0
+        self.resent_bytes = 0
+        self.timeouts = 0
+        self.nacks = 0
+        self.read_bytes = 0
+        self.written_bytes = 0
+        self.read_retry = RetryPolicy()
+        self.write_retry = RetryPolicy()
+        self.tracer = None
+        
+    @property
+    def chip_id(self):
+        return self._chip_id
+    
+    @property
+    def iface(self):
+        return self._iface
+    
+    def set_iface(self, iface):
+        if not isinstance(iface, can.BusABC):
+            raise TypeError('canbus interface not compatible')
+        self._iface = iface
+        self._flush_inbox()
+    
+    @property
+    def inbox_dropped(self):
+        return dict(self._inbox_dropped)
+    
+    def _inbox_put(self, frame):
+        aid = frame.arbitration_id
+        queue = self._inbox.get(aid)
+        if queue == None:
+            queue = self._inbox[aid] = collections.deque()
+        if len(queue) >= self.INBOX_SIZE:
+            queue.popleft()
+            self._inbox_dropped[aid] += 1
+        queue.append(frame)
+    
+    def _inbox_get(self, checker=None):
+        for queue in self._inbox.values():
+            for i, frame in enumerate(queue):
+                if checker == None or checker(frame):
+                    del queue[i]
+                    return frame
+        return None
+    
+    def _drain(self, arb_id=None):
+        while True:
+            frame = self._iface.recv(0.0)
+            if frame == None:
+                break
+            self._received(frame)
+            self._inbox_put(frame)
+        self._flush_inbox(arb_id)
+    
+    def _with_retry(self, policy, arb_id, address, size, function, *args):
+        attempt = 1
+        while True:
+            try:
+                return function(*args)
+            except (TimeoutError, ConnectionError) as e:
+                if not self._retrying(policy, address, size, e, attempt):
+                    raise
+                time.sleep(policy.delay(attempt))
+                self._drain(arb_id)
+                attempt += 1
+    
+    def _retrying(self, policy, address, size, error, attempt):
+        if attempt > policy.retries:
+            return False
+        log.warning('Page at 0x{address:08X} failed: {error}. Retrying ({attempt}/{retries})'.format(address=address, error=error, attempt=attempt, retries=policy.retries))
+        self.retries += 1
+        self.resent_bytes += size
+        return True
+    
+    def _flush_inbox(self, arb_id=None):
+        if arb_id == None:
+            self._inbox.clear()
+        else:
+            self._inbox.pop(arb_id, None)
         
     def _send(self, msg):
         try:
             self._iface.send(msg)
-            log.debug('TX: '+canframe_to_string(msg))
+            if self.tracer != None:
+                self.tracer.frame('TX', msg, self.REPLY_IDS.get(msg.arbitration_id))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('TX: '+canframe_to_string(msg))
         except can.CanError:
             raise IOError('Sending error')
     
-    def _recv(self, timeout=None, checker=None):
+    def _received(self, frame):
+        if self.tracer != None:
+            self.tracer.frame('RX', frame)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('RX: '+canframe_to_string(frame))
+    
+    def _recv(self, timeout=None, checker=None, expected=True):
         if timeout == None:
             t = self.RECV_TIMEOUT
         else:
             t = timeout
-        time = current_time()
-        response = None
-        while current_time() - time < t:
-            frame = self._iface.recv(0.0)
+        deadline = current_time() + t
+        response = self._inbox_get(checker)
+        remaining = t
+        while response == None and remaining > 0.0:
+            frame = self._iface.recv(remaining)
             if frame:
-                if checker != None:
-                    if not checker(frame):
-                        continue                
-                response = frame
-                break
+                self._received(frame)
+                if checker == None or checker(frame):
+                    response = frame
+                    break
+                self._inbox_put(frame)
+            remaining = deadline - current_time()
 
-        if not response:
+        if response == None:
+            if expected:
+                self.timeouts += 1
             raise TimeoutError('Receiving timeout')
         
-        log.debug('RX: '+canframe_to_string(response))
         return response
         
     def connect(self):
@@ -113,17 +222,27 @@ class AbstractProtocol(object):
         except AttributeError as e:
             raise NotImplementedError('Disconnect method not implemented')
     
-    def read(self, address, size):
+    def read(self, address, size, sink=None):
         try:
-            return self._read(address, size)
+            data = self._read(address, size, sink)
         except AttributeError as e:
             raise NotImplementedError('Read method not implemented')
+        self.read_bytes += size
+        return data
     
-    def write(self, address, data):
+    def write(self, address, data, progress=None):
         try:
-            self._write(address, data)
+            self._write(address, data, progress)
         except AttributeError as e:
             raise NotImplementedError('Write method not implemented')
+        self.written_bytes += len(data)
+    
+    def write_plan(self, pages, progress=None):
+        try:
+            self._write_plan(pages, progress)
+        except AttributeError as e:
+            raise NotImplementedError('Write plan method not implemented')
+        self.written_bytes += sum(page.size for page in pages)
     
     def erase(self, pages):
         try:
@@ -154,3 +273,171 @@ class AbstractProtocol(object):
             self._speed(bps)
         except AttributeError as e:
             raise NotImplementedError('Speed method not implemented')
+    
+    def sync(self):
+        try:
+            self._sync()
+        except AttributeError as e:
+            raise NotImplementedError('Sync method not implemented')
+    
+    def ping(self):
+        try:
+            return self._ping()
+        except AttributeError as e:
+            raise NotImplementedError('Ping method not implemented')
+    
+    @classmethod
+    def encode_page(cls, address, size):
+        try:
+            return cls._encode_page(address, size)
+        except AttributeError as e:
+            raise NotImplementedError('Encode page method not implemented')
+
+    def sectors(self):
+        try:
+            return self._sectors()
+        except AttributeError as e:
+            raise NotImplementedError('Sectors method not implemented')
+
+class AsyncAbstractProtocol(AbstractProtocol):
+    '''
+    Same interface as AbstractProtocol with coroutine methods. Frames are
+    delivered by a can.Notifier bound to the running event loop, so any
+    number of targets can share one loop. It is started by connect() or by
+    the first frame wait. Wrap calls in asyncio.wait_for()
+    to put a deadline on a whole operation; cancellation stops it at the
+    next frame wait.
+    '''
+
+    def __init__(self, iface):
+        super().__init__(iface)
+        self._reader = None
+        self._notifier = None
+    
+    def _start(self):
+        if self._notifier == None:
+            self._reader = can.AsyncBufferedReader()
+            self._notifier = can.Notifier(self._iface, [self._reader], loop=asyncio.get_running_loop())
+    
+    def _stop(self):
+        if self._notifier != None:
+            self._notifier.stop()
+            self._notifier = None
+            self._reader = None
+    
+    def _drain(self, arb_id=None):
+        while self._reader != None:
+            try:
+                frame = self._reader.buffer.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            self._received(frame)
+            self._inbox_put(frame)
+        self._flush_inbox(arb_id)
+    
+    async def _with_retry(self, policy, arb_id, address, size, function, *args):
+        attempt = 1
+        while True:
+            try:
+                return await function(*args)
+            except (TimeoutError, ConnectionError) as e:
+                if not self._retrying(policy, address, size, e, attempt):
+                    raise
+                await asyncio.sleep(policy.delay(attempt))
+                self._drain(arb_id)
+                attempt += 1
+    
+    async def _recv(self, timeout=None, checker=None, expected=True):
+        if timeout == None:
+            t = self.RECV_TIMEOUT
+        else:
+            t = timeout
+        self._start()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + t
+        response = self._inbox_get(checker)
+        remaining = t
+        while response == None and remaining > 0.0:
+            try:
+                frame = await asyncio.wait_for(self._reader.get_message(), remaining)
+            except asyncio.TimeoutError:
+                break
+            self._received(frame)
+            if checker == None or checker(frame):
+                response = frame
+                break
+            self._inbox_put(frame)
+            remaining = deadline - loop.time()
+
+        if response == None:
+            if expected:
+                self.timeouts += 1
+            raise TimeoutError('Receiving timeout')
+        
+        return response
+        
+    async def connect(self):
+        self._start()
+        try:
+            await self._connect()
+        except AttributeError as e:
+            raise NotImplementedError('Connect method not implemented')
+    
+    async def disconnect(self):
+        try:
+            await self._disconnect()
+        except AttributeError as e:
+            raise NotImplementedError('Disconnect method not implemented')
+        finally:
+            self._stop()
+    
+    async def read(self, address, size):
+        try:
+            data = await self._read(address, size)
+        except AttributeError as e:
+            raise NotImplementedError('Read method not implemented')
+        self.read_bytes += size
+        return data
+    
+    async def write(self, address, data):
+        try:
+            await self._write(address, data)
+        except AttributeError as e:
+            raise NotImplementedError('Write method not implemented')
+        self.written_bytes += len(data)
+    
+    async def erase(self, pages):
+        try:
+            await self._erase(pages)
+        except AttributeError as e:
+            raise NotImplementedError('Erase method not implemented')
+        
+    async def lock(self):
+        try:
+            await self._lock()
+        except AttributeError as e:
+            raise NotImplementedError('Lock method not implemented')
+    
+    async def unlock(self):
+        try:
+            await self._unlock()
+        except AttributeError as e:
+            raise NotImplementedError('Unlock method not implemented')
+    
+    async def go(self, address):
+        try:
+            await self._go(address)
+        except AttributeError as e:
+            raise NotImplementedError('Go method not implemented')
+
+    async def speed(self, bps):
+        try:
+            await self._speed(bps)
+        except AttributeError as e:
+            raise NotImplementedError('Speed method not implemented')
+    
+    async def ping(self):
+        try:
+            return await self._ping()
+        except AttributeError as e:
+            raise NotImplementedError('Ping method not implemented')
@@ -25,7 +25,8 @@
 import can
 import struct
 
-from . import AbstractProtocol
+from .abstract import AbstractProtocol, AsyncAbstractProtocol
+from .abstract import current_time, RetryPolicy
 
 from canprog.logger import log
 
@@ -42,8 +43,16 @@ CMD_WRITE_UNPROTECT = 0x73
 CMD_READOUT_PROTECT = 0x82
 CMD_READOUT_UNPROTECT = 0x92
 
+READ_RETRIES = 2
+WRITE_RETRIES = 2
+
+MAX_ERASE_PAGE = 0xFF
+MAX_ERASE_BATCH = 0xFF
+
 MASSERASE_MAX_TIMEOUT = 30.0
+SECTOR_ERASE_MAX_TIMEOUT = 4.0
 UNPROTECT_MAX_TIMEOUT = 2.0
+SPEED_SYNC_TIMEOUT = 0.2
 
 BYTE_ACK = 0x79
 BYTE_NOACK = 0x1F
@@ -105,6 +114,82 @@ CHIP_ID = { 0x440: "STM32F05xxx & STM32F030x8",
             0x415: "STM32L47xxx/48xxx",
             0x461: "STM32L496xx/4A6xx",} 
 
+FLASH_BASE = 0x08000000
+
+K = 1024
+
+FLASH_LAYOUT_F0_1K = ((64, 1*K),)
+FLASH_LAYOUT_F0_2K = ((128, 2*K),)
+FLASH_LAYOUT_F1_1K = ((128, 1*K),)
+FLASH_LAYOUT_F1_2K = ((256, 2*K),)
+FLASH_LAYOUT_F1_XL = ((512, 2*K),)
+FLASH_LAYOUT_F3 = ((256, 2*K),)
+FLASH_LAYOUT_F2_F4 = ((4, 16*K), (1, 64*K), (7, 128*K))
+FLASH_LAYOUT_F413 = ((4, 16*K), (1, 64*K), (11, 128*K))
+FLASH_LAYOUT_F42_F43 = ((4, 16*K), (1, 64*K), (7, 128*K), (4, 16*K), (1, 64*K), (7, 128*K))
+FLASH_LAYOUT_F72 = ((4, 16*K), (1, 64*K), (3, 128*K))
+FLASH_LAYOUT_F74_F76 = ((4, 32*K), (1, 128*K), (7, 256*K))
+FLASH_LAYOUT_H74_H75 = ((16, 128*K),)
+FLASH_LAYOUT_L4 = ((512, 2*K),)
+
+FLASH_LAYOUT = { 0x440: FLASH_LAYOUT_F0_1K,
+                 0x444: FLASH_LAYOUT_F0_1K,
+                 0x445: FLASH_LAYOUT_F0_1K,
+                 0x448: FLASH_LAYOUT_F0_2K,
+                 0x442: FLASH_LAYOUT_F0_2K,
+                 
+                 0x412: FLASH_LAYOUT_F1_1K,
+                 0x410: FLASH_LAYOUT_F1_1K,
+                 0x420: FLASH_LAYOUT_F1_1K,
+                 0x414: FLASH_LAYOUT_F1_2K,
+                 0x428: FLASH_LAYOUT_F1_2K,
+                 0x418: FLASH_LAYOUT_F1_2K,
+                 0x430: FLASH_LAYOUT_F1_XL,
+                 
+                 0x411: FLASH_LAYOUT_F2_F4,
+                 
+                 0x432: FLASH_LAYOUT_F3,
+                 0x422: FLASH_LAYOUT_F3,
+                 0x439: FLASH_LAYOUT_F3,
+                 0x438: FLASH_LAYOUT_F3,
+                 0x446: FLASH_LAYOUT_F3,
+                 
+                 0x413: FLASH_LAYOUT_F2_F4,
+                 0x423: FLASH_LAYOUT_F2_F4,
+                 0x433: FLASH_LAYOUT_F2_F4,
+                 0x458: FLASH_LAYOUT_F2_F4,
+                 0x431: FLASH_LAYOUT_F2_F4,
+                 0x441: FLASH_LAYOUT_F2_F4,
+                 0x421: FLASH_LAYOUT_F2_F4,
+                 0x419: FLASH_LAYOUT_F42_F43,
+                 0x434: FLASH_LAYOUT_F42_F43,
+                 0x463: FLASH_LAYOUT_F413,
+                 
+                 0x452: FLASH_LAYOUT_F72,
+                 0x449: FLASH_LAYOUT_F74_F76,
+                 0x451: FLASH_LAYOUT_F74_F76,
+                 
+                 0x450: FLASH_LAYOUT_H74_H75,
+                 
+                 0x435: FLASH_LAYOUT_L4,
+                 0x462: FLASH_LAYOUT_L4,
+                 0x415: FLASH_LAYOUT_L4,
+                 0x461: FLASH_LAYOUT_L4,}
+
+SPEEDS = (125000, 250000, 500000, 1000000)
+
+def speed_code(bps):
+    if bps == 125000:
+        return 1
+    elif bps == 250000:
+        return 2
+    elif bps == 500000:
+        return 3
+    elif bps == 1000000:
+        return 4
+    else:
+        raise NotImplementedError('Unsupported speed %d bps' % (bps,))
+
 def _check_support(cmd):
     def func_wrapper(function):
         def call_wrapper(*args):
@@ -116,10 +201,19 @@ def _check_support(cmd):
         return call_wrapper
     return func_wrapper
 
-class STM32Protocol(AbstractProtocol):
+class STM32Mixin(object):
+    
+    FRAME_SIZE = 8
+    REPLY_IDS = {BYTE_DATA: CMD_WRITE_MEMORY}
+    MAX_ERASE_PAGE = MAX_ERASE_PAGE
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.write_window = 1
+        self.read_pipeline = False
+        self.read_retry = RetryPolicy(READ_RETRIES)
+        self.write_retry = RetryPolicy(WRITE_RETRIES)
+        self.capabilities = None
         self._supported_commands = {  CMD_GET_COMMANDS: {'name': 'GET', 'support': False},
                                       CMD_GET_VERSION: {'name': 'GET_VERSION', 'support': False},
                                       CMD_GET_ID: {'name': 'GET_ID', 'support': False},
@@ -155,16 +249,105 @@ class STM32Protocol(AbstractProtocol):
     
     def _check_ack_or_noack(self, arb_id):
         return self._check_response(arb_id, 1, (BYTE_ACK, BYTE_NOACK))
+        
+    def _message(self, cmd, data):
+        return can.Message(arbitration_id=cmd, data=data, is_extended_id=False)
+    
+    def _send_data(self, cmd, data=[]):
+        self._send(self._message(cmd, data))
+    
+    @staticmethod
+    def _encode_page(address, size):
+        return struct.pack(">IB", address, size - 1)
+    
+    def _frame_length(self, size):
+        return min(size, self.FRAME_SIZE)
+    
+    def _chunks(self, data):
+        i = 0
+        while i < len(data):
+            n = self._frame_length(len(data) - i)
+            yield data[i:i+n]
+            i += n
+    
+    def _page_frames(self, header, data):
+        frames = [self._message(CMD_WRITE_MEMORY, header)]
+        for chunk in self._chunks(data):
+            frames.append(self._message(BYTE_DATA, chunk))
+        return frames
+    
+    def _set_commands(self, commands, boot_version):
+        for k, v in self._supported_commands.items():
+            v['support'] = True if k in commands else False
+
+        self._bootloader_version = '{}.{}'.format((boot_version>>4)&0x0F, (boot_version)&0x0F)
+    
+    def _cached_commands(self, boot_version):
+        commands = self.capabilities.get(self._chip_id, boot_version)
+        if commands == None:
+            return None
+        if CMD_GET_VERSION not in commands or CMD_GET_ID not in commands:
+            log.warning('Cached commands do not match the target')
+            return None
+        return commands
+    
+    def _erase_batches(self, pages):
+        for p in pages:
+            if p > MAX_ERASE_PAGE:
+                raise ValueError('Page number 0x{:X} out of range'.format(p))
+        return [pages[i:i+MAX_ERASE_BATCH] for i in range(0, len(pages), MAX_ERASE_BATCH)]
+    
+    def _set_read_protection(self, option_msg):
+        self._read_protection_bytes = '0x{}'.format(''.join(['{:02X}'.format(i) for i in option_msg]))
+    
+    def _set_chip_id(self, chip_id):
+        self._chip_id = '0x{}'.format(''.join(['{:02X}'.format(i) for i in chip_id]))
+        
+        try:
+            name = CHIP_ID[int(self._chip_id,0)]
+        except KeyError:
+            name = 'Unknown CHIP ID'
+            
+        log.info('Chip ID: {hexid} - {name}'.format(hexid=self._chip_id, name=name))
+    
+    def _sectors(self):
+        if self._chip_id == None:
+            return []
+        try:
+            layout = FLASH_LAYOUT[int(self._chip_id,0)]
+        except KeyError:
+            return []
+        
+        sectors = []
+        address = FLASH_BASE
+        for count, size in layout:
+            for _ in range(count):
+                sectors.append((len(sectors), address, size,))
+                address += size
+        return sectors
+
+class STM32Protocol(STM32Mixin, AbstractProtocol):
     
     def _wait_for_ack(self, cmd, timeout=None):
         self._recv(timeout=timeout, checker=self._check_ack(cmd))
         
-    def _send_data(self, cmd, data=[]):
-        self._send(can.Message(arbitration_id=cmd, data=data, extended_id=False))
+    def _wait_for_ack_or_noack(self, cmd, timeout=None, expected=True):
+        msg = self._recv(timeout=timeout, checker=self._check_ack_or_noack(cmd), expected=expected)
+        if msg.data[0] == BYTE_NOACK:
+            self.nacks += 1
+            raise ConnectionError('Command 0x{:02X} not acknowledged'.format(cmd))
     
-    def _init(self):
+    def _init(self, expected=True):
+        self._flush_inbox()
         self._send_data(BYTE_INIT)
-        self._recv(checker=self._check_ack_or_noack(BYTE_INIT))
+        self._recv(checker=self._check_ack_or_noack(BYTE_INIT), expected=expected)
+    
+    def _ping(self):
+        try:
+            self._init(False)
+        except TimeoutError:
+            return False
+        return True
         
     def _recv_data(self, cmd, size=None):
         msg = self._recv(checker=self._check_response(cmd, size))
@@ -183,39 +366,68 @@ class STM32Protocol(AbstractProtocol):
             commands.append(cmd)
             
         self._wait_for_ack(CMD_GET_COMMANDS)
-
-        for k, v in self._supported_commands.items():
-            v['support'] = True if k in commands else False
-
-        self._bootloader_version = '{}.{}'.format((boot_version>>4)&0x0F, (boot_version)&0x0F)
+        
+        self._set_commands(commands, boot_version)
+        return commands
     
     @_check_support(CMD_GET_VERSION)
     def _get_version(self):
-
+        boot_version, option_msg = self._request_version()
+        self._set_read_protection(option_msg)
+    
+    def _request_version(self):
         self._send_data(CMD_GET_VERSION)
 
-        self._wait_for_ack(CMD_GET_VERSION)
-        self._recv_data(CMD_GET_VERSION, 1)
+        self._wait_for_ack_or_noack(CMD_GET_VERSION)
+        boot_version = self._recv_data(CMD_GET_VERSION, 1)[0]
         option_msg = self._recv_data(CMD_GET_VERSION, 2)[0:2]
         
         self._wait_for_ack(CMD_GET_VERSION)
-        
-        self._read_protection_bytes = '0x{}'.format(''.join(['{:02X}'.format(i) for i in option_msg]))
+        return boot_version, option_msg
     
     @_check_support(CMD_GET_ID)
     def _get_id(self):
+        self._set_chip_id(self._request_id())
+    
+    def _request_id(self):
         self._send_data(CMD_GET_ID)
 
-        self._wait_for_ack(CMD_GET_ID)
+        self._wait_for_ack_or_noack(CMD_GET_ID)
         chip_id = self._recv_data(CMD_GET_ID)
         self._wait_for_ack(CMD_GET_ID)
-        
-        self._chip_id = '0x{}'.format(''.join(['{:02X}'.format(i) for i in chip_id]))
+        return chip_id
         
     def _connect(self):
         self._init()
         log.info('Bootloader initialized')
         
+        if self.capabilities != None:
+            try:
+                self._connect_cached()
+                return
+            except (TimeoutError, ConnectionError) as e:
+                log.warning('Short handshake failed: {}. Running full handshake'.format(e))
+                self._flush_inbox()
+        
+        self._connect_full()
+    
+    def _connect_cached(self):
+        boot_version, option_msg = self._request_version()
+        self._set_chip_id(self._request_id())
+        
+        commands = self._cached_commands(boot_version)
+        if commands == None:
+            commands = self._get_commands()
+            self.capabilities.put(self._chip_id, boot_version, commands)
+        else:
+            self._set_commands(commands, boot_version)
+            log.info('Commands loaded from cache')
+        
+        log.info('Bootloader version: {version}'.format(version=self._bootloader_version))
+        self._set_read_protection(option_msg)
+        log.info('Read protection: {bytes}'.format(bytes=self._read_protection_bytes))
+    
+    def _connect_full(self):
         self._get_commands()       
                 
         log.info('Bootloader version: {version}'.format(version=self._bootloader_version))
@@ -228,13 +440,6 @@ class STM32Protocol(AbstractProtocol):
         
         try:
             self._get_id()
-            
-            try:
-                name = CHIP_ID[int(self._chip_id,0)]
-            except KeyError:
-                name = 'Unknown CHIP ID'
-                
-            log.info('Chip ID: {hexid} - {name}'.format(hexid=self._chip_id, name=name))
         except NotImplementedError as e:
             pass
         
@@ -245,14 +450,13 @@ class STM32Protocol(AbstractProtocol):
         i = 1
         while True:
             try:
-                self._wait_for_ack(cmd, timeout=1.0)
+                self._wait_for_ack_or_noack(cmd, timeout=1.0, expected=i >= seconds)
                 break
             except TimeoutError as e:
                 log.info('Waiting... {}s'.format(i))
                 if i >= seconds:
                     raise
-                else:                    
-                    i += 1
+                i += 1
     
     @_check_support(CMD_GO)
     def _go(self, address):
@@ -282,15 +486,31 @@ class STM32Protocol(AbstractProtocol):
             log.info('Mass erasing. Please wait..')
             self._erase_page(0xFF);
         else:
-            for p in pages:
-                log.info('Erasing sector {:02X}'.format(p))
-                self._send_data(CMD_ERASE, (0,))        
-                self._wait_for_ack(CMD_ERASE)
-                self._erase_page(p);
-                
+            for batch in self._erase_batches(pages):
+                log.info('Erasing sectors {}'.format(' '.join('{:02X}'.format(p) for p in batch)))
+                start = current_time()
+                try:
+                    self._erase_batch(batch)
+                except ConnectionError as e:
+                    if len(batch) == 1:
+                        raise
+                    log.warning('Batch erase not accepted: {}. Erasing one sector at a time'.format(e))
+                    self._drain(CMD_ERASE)
+                    for p in batch:
+                        self._erase_batch((p,))
+                log.info('Erased {} sectors in {:.2f}s'.format(len(batch), current_time() - start))
+    
+    def _erase_batch(self, pages):
+        self._send_data(CMD_ERASE, (len(pages) - 1,))
+        self._wait_for_ack_or_noack(CMD_ERASE)
+        for chunk in self._chunks(pages):
+            self._send_data(CMD_ERASE, chunk)
+            self._wait_for_ack_or_noack(CMD_ERASE)
+        self._wait_ack(CMD_ERASE, max(MASSERASE_MAX_TIMEOUT, SECTOR_ERASE_MAX_TIMEOUT * len(pages)))
     
     @_check_support(CMD_WRITE_MEMORY)  
-    def _write(self, address, data):
+    def _write(self, address, data, progress=None):
+        data = memoryview(data)
         size = len(data)
         
         last_p = -1
@@ -299,23 +519,388 @@ class STM32Protocol(AbstractProtocol):
             if (last_p == -1) or (p - last_p >= 10):
                 log.info('Progress: {}%'.format(p))
                 last_p = p
-            self._write_page(address+i, data[i:i+256])
+            page = data[i:i+256]
+            self._with_retry(self.write_retry, CMD_WRITE_MEMORY, address+i, len(page), self._write_page, address+i, page)
+            if progress != None:
+                progress(address+i, len(page))
         log.info('Progress: 100%')
     
     def _write_page(self, address, data):
-        size = len(data)
-        self._send_data(CMD_WRITE_MEMORY, struct.pack(">IB", address, size - 1))        
-        self._wait_for_ack(CMD_WRITE_MEMORY)
+        self._write_page_frames(address, self._page_frames(self._encode_page(address, len(data)), data))
         
-        for i in range(0, size, 8):
-            self._send_data(BYTE_DATA, data[i:i+8])      
-            self._wait_for_ack(CMD_WRITE_MEMORY)
+    @_check_support(CMD_WRITE_MEMORY)
+    def _write_plan(self, pages, progress=None):
+        size = sum(page.size for page in pages)
+        done = 0
         
-        self._wait_for_ack(CMD_WRITE_MEMORY)        
+        last_p = -1
+        for page in pages:
+            p = int(100.0 * done / size)
+            if (last_p == -1) or (p - last_p >= 10):
+                log.info('Progress: {}%'.format(p))
+                last_p = p
+            frames = page.frames
+            if frames == None:
+                frames = page.frames = self._page_frames(page.header, page.data)
+            self._with_retry(self.write_retry, CMD_WRITE_MEMORY, page.address, page.size, self._write_page_frames, page.address, frames)
+            done += page.size
+            if progress != None:
+                progress(page.address, page.size)
+        log.info('Progress: 100%')
+    
+    def _write_page_frames(self, address, frames):
+        if self.write_window > 1:
+            try:
+                self._write_frames(frames, self.write_window)
+                return
+            except (TimeoutError, ConnectionError) as e:
+                log.warning('Pipelined write at 0x{:08X} failed: {}. Falling back to lock-step'.format(address, e))
+                self.write_window = 1
+                self._drain(CMD_WRITE_MEMORY)
+        self._write_frames(frames, 1)
+    
+    def _write_frames(self, frames, window):
+        self._send(frames[0])
+        self._wait_for_ack_or_noack(CMD_WRITE_MEMORY)
+        
+        pending = 0
+        for frame in frames[1:]:
+            if pending >= window:
+                self._wait_for_ack_or_noack(CMD_WRITE_MEMORY)
+                pending -= 1
+            self._send(frame)
+            pending += 1
+        
+        while pending > 0:
+            self._wait_for_ack_or_noack(CMD_WRITE_MEMORY)
+            pending -= 1
+        
+        self._wait_for_ack_or_noack(CMD_WRITE_MEMORY)
         
     @_check_support(CMD_READ_MEMORY)  
-    def _read(self, address, size):
+    def _read(self, address, size, sink=None):
+        if sink == None:
+            data = bytearray(size)
+        else:
+            data = bytearray(min(256, size))
+        view = memoryview(data)
+        start = current_time()
+        
+        last_p = -1
+        self._read_pending = None
+        for offset in range(0, size, 256):
+            p = int(100.0 * offset / size)
+            if (last_p == -1) or (p - last_p >= 10):
+                log.info('Progress: {}%'.format(p))
+                last_p = p
+                
+            to_read = min(256, size - offset)
+            if sink == None:
+                buf = view[offset:offset+to_read]
+            else:
+                buf = view[:to_read]
+            
+            follow = None
+            next_offset = offset + to_read
+            if self.read_pipeline and next_offset < size:
+                follow = (address + next_offset, min(256, size - next_offset),)
+            
+            self._with_retry(self.read_retry, CMD_READ_MEMORY, address + offset, to_read, self._read_page_retry, address + offset, buf, follow)
+            
+            if sink != None:
+                sink(address + offset, buf)
+        
+        log.info('Progress: 100%')
+        
+        elapsed = current_time() - start
+        if elapsed > 0.0:
+            log.info('Read {size} bytes in {elapsed:.2f}s ({rate:.0f} B/s)'.format(size=size, elapsed=elapsed, rate=size/elapsed))
+        
+        if sink == None:
+            return data
+    
+    def _send_read_command(self, address, size):
+        self._send_data(CMD_READ_MEMORY, struct.pack(">IB", address, size - 1))
+    
+    def _read_page_retry(self, address, buf, follow):
+        if self._read_pending != address:
+            self._send_read_command(address, len(buf))
+        self._read_pending = None
+        if not self.read_pipeline:
+            follow = None
+        try:
+            self._read_page_into(buf, follow)
+        except (TimeoutError, ConnectionError):
+            self.read_pipeline = False
+            raise
+        if follow != None:
+            self._read_pending = follow[0]
+    
+    def _read_page_into(self, buf, follow=None):
+        self._wait_for_ack_or_noack(CMD_READ_MEMORY)
+        
+        size = len(buf)
+        received = 0
+        while received < size:
+            data = self._recv_data(CMD_READ_MEMORY)
+            n = min(len(data), size - received)
+            buf[received:received+n] = data[:n]
+            received += n
+        
+        if follow != None:
+            self._send_read_command(*follow)
+        
+        self._wait_for_ack(CMD_READ_MEMORY)
+    
+    def _read_page(self, address, size):
+        page = bytearray(size)
+        self._send_read_command(address, size)
+        self._read_page_into(memoryview(page))
+        return page
 
+    @_check_support(CMD_CHANGE_SPEED)
+    def _speed(self, bps):
+        self._send_data(CMD_CHANGE_SPEED, struct.pack(">B", speed_code(bps)))
+        self._wait_for_ack_or_noack(CMD_CHANGE_SPEED)
+    
+    def _sync(self):
+        try:
+            self._recv(timeout=SPEED_SYNC_TIMEOUT, checker=self._check_ack(CMD_CHANGE_SPEED), expected=False)
+        except TimeoutError:
+            pass
+        self._request_version()
+
+class AsyncSTM32Protocol(STM32Mixin, AsyncAbstractProtocol):
+    
+    async def _wait_for_ack(self, cmd, timeout=None):
+        await self._recv(timeout=timeout, checker=self._check_ack(cmd))
+        
+    async def _wait_for_ack_or_noack(self, cmd, timeout=None, expected=True):
+        msg = await self._recv(timeout=timeout, checker=self._check_ack_or_noack(cmd), expected=expected)
+        if msg.data[0] == BYTE_NOACK:
+            self.nacks += 1
+            raise ConnectionError('Command 0x{:02X} not acknowledged'.format(cmd))
+    
+    async def _init(self, expected=True):
+        self._flush_inbox()
+        self._send_data(BYTE_INIT)
+        await self._recv(checker=self._check_ack_or_noack(BYTE_INIT), expected=expected)
+    
+    async def _ping(self):
+        try:
+            await self._init(False)
+        except TimeoutError:
+            return False
+        return True
+        
+    async def _recv_data(self, cmd, size=None):
+        msg = await self._recv(checker=self._check_response(cmd, size))
+        return msg.data
+        
+    async def _get_commands(self):
+        self._send_data(CMD_GET_COMMANDS)
+
+        await self._wait_for_ack(CMD_GET_COMMANDS)
+        commands_num = (await self._recv_data(CMD_GET_COMMANDS, 1))[0]
+        boot_version = (await self._recv_data(CMD_GET_COMMANDS, 1))[0]
+        
+        commands = []
+        for _ in range(commands_num):
+            cmd = (await self._recv_data(CMD_GET_COMMANDS, 1))[0]
+            commands.append(cmd)
+            
+        await self._wait_for_ack(CMD_GET_COMMANDS)
+        
+        self._set_commands(commands, boot_version)
+        return commands
+    
+    @_check_support(CMD_GET_VERSION)
+    async def _get_version(self):
+        boot_version, option_msg = await self._request_version()
+        self._set_read_protection(option_msg)
+    
+    async def _request_version(self):
+        self._send_data(CMD_GET_VERSION)
+
+        await self._wait_for_ack_or_noack(CMD_GET_VERSION)
+        boot_version = (await self._recv_data(CMD_GET_VERSION, 1))[0]
+        option_msg = (await self._recv_data(CMD_GET_VERSION, 2))[0:2]
+        
+        await self._wait_for_ack(CMD_GET_VERSION)
+        return boot_version, option_msg
+    
+    @_check_support(CMD_GET_ID)
+    async def _get_id(self):
+        self._set_chip_id(await self._request_id())
+    
+    async def _request_id(self):
+        self._send_data(CMD_GET_ID)
+
+        await self._wait_for_ack_or_noack(CMD_GET_ID)
+        chip_id = await self._recv_data(CMD_GET_ID)
+        await self._wait_for_ack(CMD_GET_ID)
+        return chip_id
+        
+    async def _connect(self):
+        await self._init()
+        log.info('Bootloader initialized')
+        
+        if self.capabilities != None:
+            try:
+                await self._connect_cached()
+                return
+            except (TimeoutError, ConnectionError) as e:
+                log.warning('Short handshake failed: {}. Running full handshake'.format(e))
+                self._flush_inbox()
+        
+        await self._connect_full()
+    
+    async def _connect_cached(self):
+        boot_version, option_msg = await self._request_version()
+        self._set_chip_id(await self._request_id())
+        
+        commands = self._cached_commands(boot_version)
+        if commands == None:
+            commands = await self._get_commands()
+            self.capabilities.put(self._chip_id, boot_version, commands)
+        else:
+            self._set_commands(commands, boot_version)
+            log.info('Commands loaded from cache')
+        
+        log.info('Bootloader version: {version}'.format(version=self._bootloader_version))
+        self._set_read_protection(option_msg)
+        log.info('Read protection: {bytes}'.format(bytes=self._read_protection_bytes))
+    
+    async def _connect_full(self):
+        await self._get_commands()
+        
+        log.info('Bootloader version: {version}'.format(version=self._bootloader_version))
+        
+        try:
+            await self._get_version()
+            log.info('Read protection: {bytes}'.format(bytes=self._read_protection_bytes))
+        except NotImplementedError as e:
+            pass
+        
+        try:
+            await self._get_id()
+        except NotImplementedError as e:
+            pass
+        
+    async def _disconnect(self):
+        pass
+    
+    async def _wait_ack(self, cmd, seconds=30):
+        i = 1
+        while True:
+            try:
+                await self._wait_for_ack_or_noack(cmd, timeout=1.0, expected=i >= seconds)
+                break
+            except TimeoutError as e:
+                log.info('Waiting... {}s'.format(i))
+                if i >= seconds:
+                    raise
+                i += 1
+    
+    @_check_support(CMD_GO)
+    async def _go(self, address):
+        self._send_data(CMD_GO, struct.pack(">I", address))
+        await self._wait_for_ack(CMD_GO)
+        
+    @_check_support(CMD_READOUT_PROTECT)
+    async def _lock(self):
+        self._send_data(CMD_READOUT_PROTECT)
+        await self._wait_for_ack(CMD_READOUT_PROTECT)
+        await self._wait_ack(CMD_READOUT_PROTECT, UNPROTECT_MAX_TIMEOUT)
+        
+    @_check_support(CMD_READOUT_UNPROTECT)
+    async def _unlock(self):
+        self._send_data(CMD_READOUT_UNPROTECT)
+        await self._wait_for_ack(CMD_READOUT_UNPROTECT)
+        await self._wait_ack(CMD_READOUT_UNPROTECT, MASSERASE_MAX_TIMEOUT)
+        
+    async def _erase_page(self, p):
+        self._send_data(CMD_ERASE, (p,))
+        await self._wait_for_ack(CMD_ERASE)
+        await self._wait_ack(CMD_ERASE, MASSERASE_MAX_TIMEOUT)
+                    
+    @_check_support(CMD_ERASE)
+    async def _erase(self, pages):
+        if len(pages) == 0:
+            log.info('Mass erasing. Please wait..')
+            await self._erase_page(0xFF)
+        else:
+            for batch in self._erase_batches(pages):
+                log.info('Erasing sectors {}'.format(' '.join('{:02X}'.format(p) for p in batch)))
+                start = current_time()
+                try:
+                    await self._erase_batch(batch)
+                except ConnectionError as e:
+                    if len(batch) == 1:
+                        raise
+                    log.warning('Batch erase not accepted: {}. Erasing one sector at a time'.format(e))
+                    self._drain(CMD_ERASE)
+                    for p in batch:
+                        await self._erase_batch((p,))
+                log.info('Erased {} sectors in {:.2f}s'.format(len(batch), current_time() - start))
+    
+    async def _erase_batch(self, pages):
+        self._send_data(CMD_ERASE, (len(pages) - 1,))
+        await self._wait_for_ack_or_noack(CMD_ERASE)
+        for chunk in self._chunks(pages):
+            self._send_data(CMD_ERASE, chunk)
+            await self._wait_for_ack_or_noack(CMD_ERASE)
+        await self._wait_ack(CMD_ERASE, max(MASSERASE_MAX_TIMEOUT, SECTOR_ERASE_MAX_TIMEOUT * len(pages)))
+    
+    @_check_support(CMD_WRITE_MEMORY)
+    async def _write(self, address, data):
+        data = memoryview(data)
+        size = len(data)
+        
+        last_p = -1
+        for i in range(0, size, 256):
+            p = int(100.0 * i / size)
+            if (last_p == -1) or (p - last_p >= 10):
+                log.info('Progress: {}%'.format(p))
+                last_p = p
+            page = data[i:i+256]
+            await self._with_retry(self.write_retry, CMD_WRITE_MEMORY, address+i, len(page), self._write_page, address+i, page)
+        log.info('Progress: 100%')
+    
+    async def _write_page(self, address, data):
+        await self._write_page_frames(address, self._page_frames(self._encode_page(address, len(data)), data))
+    
+    async def _write_page_frames(self, address, frames):
+        if self.write_window > 1:
+            try:
+                await self._write_frames(frames, self.write_window)
+                return
+            except (TimeoutError, ConnectionError) as e:
+                log.warning('Pipelined write at 0x{:08X} failed: {}. Falling back to lock-step'.format(address, e))
+                self.write_window = 1
+                self._drain(CMD_WRITE_MEMORY)
+        await self._write_frames(frames, 1)
+    
+    async def _write_frames(self, frames, window):
+        self._send(frames[0])
+        await self._wait_for_ack_or_noack(CMD_WRITE_MEMORY)
+        
+        pending = 0
+        for frame in frames[1:]:
+            if pending >= window:
+                await self._wait_for_ack_or_noack(CMD_WRITE_MEMORY)
+                pending -= 1
+            self._send(frame)
+            pending += 1
+        
+        while pending > 0:
+            await self._wait_for_ack_or_noack(CMD_WRITE_MEMORY)
+            pending -= 1
+        
+        await self._wait_for_ack_or_noack(CMD_WRITE_MEMORY)
+        
+    @_check_support(CMD_READ_MEMORY)
+    async def _read(self, address, size):
         total = size
         last_p = -1
         data = bytearray()
@@ -327,8 +912,7 @@ class STM32Protocol(AbstractProtocol):
                 
             to_read = min(256, size)
             
-            page = self._read_page(address, to_read)
-            data += page
+            data += await self._with_retry(self.read_retry, CMD_READ_MEMORY, address, to_read, self._read_page, address, to_read)
             
             address += to_read
             size -= to_read
@@ -337,29 +921,47 @@ class STM32Protocol(AbstractProtocol):
         
         return data
     
-    def _read_page(self, address, size):
-        self._send_data(CMD_READ_MEMORY, struct.pack(">IB", address, size - 1))        
-        self._wait_for_ack(CMD_READ_MEMORY)
+    async def _read_page(self, address, size):
+        self._send_data(CMD_READ_MEMORY, struct.pack(">IB", address, size - 1))
+        await self._wait_for_ack_or_noack(CMD_READ_MEMORY)
         
         page = bytearray()
-        for _ in range(0, size, 8):
-            data = self._recv_data(CMD_READ_MEMORY)
-            page += data
+        while len(page) < size:
+            page += await self._recv_data(CMD_READ_MEMORY)
+        del page[size:]
         
-        self._wait_for_ack(CMD_READ_MEMORY)
+        await self._wait_for_ack(CMD_READ_MEMORY)
         
         return page
 
-    def _speed(self, bps):
-        if bps == 125000:
-            code = 1
-        elif bps == 250000:
-            code = 2
-        elif bps == 500000:
-            code = 3
-        elif bps == 1000000:
-            code = 4
-        else:
-            raise NotImplementedError('Unsupported speed %d bps' % (bps,))
+    @_check_support(CMD_CHANGE_SPEED)
+    async def _speed(self, bps):
+        self._send_data(CMD_CHANGE_SPEED, struct.pack(">B", speed_code(bps)))
+        await self._wait_for_ack_or_noack(CMD_CHANGE_SPEED)
+
+class STM32FDMixin(object):
+    '''
+    FDCAN ROM bootloader of newer parts (G4, H7, U5). Same commands as
+    the classic CAN one, data goes in 64-byte CAN FD frames with bitrate
+    switching.
+    '''
+    
+    FD = True
+    FRAME_SIZE = 64
+    
+    def _frame_length(self, size):
+        # CAN FD carries 0-8, 12, 16, 20, 24, 32, 48 or 64 bytes; any other
+        # length would be padded on the bus, so take the largest that fits
+        dlc = can.util.len2dlc(min(size, self.FRAME_SIZE))
+        if can.util.dlc2len(dlc) > size:
+            dlc -= 1
+        return can.util.dlc2len(dlc)
+    
+    def _message(self, cmd, data):
+        return can.Message(arbitration_id=cmd, data=data, is_extended_id=False, is_fd=True, bitrate_switch=True)
+
+class STM32FDProtocol(STM32FDMixin, STM32Protocol):
+    pass
 
-        self._send_data(CMD_CHANGE_SPEED, struct.pack(">B", code))
+class AsyncSTM32FDProtocol(STM32FDMixin, AsyncSTM32Protocol):
+    pass
@@ -0,0 +1,366 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import can
+import random
+import struct
+import threading
+import time
+
+from canprog.protocols import stm32
+
+def bitrate_channel(channel, bitrate):
+    if bitrate == None:
+        return channel
+    return '{}@{}'.format(channel, bitrate)
+
+class STM32Simulator(threading.Thread):
+    '''
+    AN3154 CAN bootloader backed by an in-memory flash array. Runs in its
+    own thread on a python-can bus (normally the 'virtual' interface) and
+    answers one command at a time like the ROM bootloader does.
+    
+    With a bitrate, each rate is a separate virtual channel named by
+    bitrate_channel() and CHANGE_SPEED moves the simulator to another one,
+    so a host at the wrong rate hears nothing.
+    '''
+    
+    DEFAULT_COMMANDS = (stm32.CMD_GET_COMMANDS, stm32.CMD_GET_VERSION, stm32.CMD_GET_ID,
+                        stm32.CMD_CHANGE_SPEED, stm32.CMD_READ_MEMORY, stm32.CMD_GO,
+                        stm32.CMD_WRITE_MEMORY, stm32.CMD_ERASE, stm32.CMD_WRITE_PROTECT,
+                        stm32.CMD_WRITE_UNPROTECT, stm32.CMD_READOUT_PROTECT, stm32.CMD_READOUT_UNPROTECT)
+    
+    FRAME_TIMEOUT = 1.0
+
+    def __init__(self, channel, interface='virtual', chip_id=0x413, version=0x20, flash_size=0x100000,
+                 latency=0.0, erase_time=0.0, nack_rate=0.0, drop_rate=0.0, seed=None, commands=None, bitrate=None, fd=False):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.frame_size = 64 if fd else 8
+        self.channel = channel
+        self.interface = interface
+        self.bitrate = bitrate
+        self._bus = can.interface.Bus(channel=bitrate_channel(channel, bitrate), interface=interface)
+        self._running = False
+        self._random = random.Random(seed)
+        
+        self.chip_id = chip_id
+        self.version = version
+        self.latency = latency
+        self.erase_time = erase_time
+        self.nack_rate = nack_rate
+        self.drop_rate = drop_rate
+        self.commands = self.DEFAULT_COMMANDS if commands == None else tuple(commands)
+        
+        self.flash_base = stm32.FLASH_BASE
+        self.flash = bytearray(b'\xFF' * flash_size)
+        self.read_protection = False
+        self.write_protected = set()
+        self.started_at = None
+        
+        self.frames_received = 0
+        self.frames_sent = 0
+        self.nacks_sent = 0
+        self.frames_dropped = 0
+        
+        self._handlers = { stm32.BYTE_INIT: self._do_init,
+                           stm32.CMD_GET_COMMANDS: self._do_get_commands,
+                           stm32.CMD_GET_VERSION: self._do_get_version,
+                           stm32.CMD_GET_ID: self._do_get_id,
+                           stm32.CMD_CHANGE_SPEED: self._do_change_speed,
+                           stm32.CMD_READ_MEMORY: self._do_read_memory,
+                           stm32.CMD_GO: self._do_go,
+                           stm32.CMD_WRITE_MEMORY: self._do_write_memory,
+                           stm32.CMD_ERASE: self._do_erase,
+                           stm32.CMD_WRITE_PROTECT: self._do_write_protect,
+                           stm32.CMD_WRITE_UNPROTECT: self._do_write_unprotect,
+                           stm32.CMD_READOUT_PROTECT: self._do_readout_protect,
+                           stm32.CMD_READOUT_UNPROTECT: self._do_readout_unprotect, }
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.stop()
+    
+    def start(self):
+        self._running = True
+        super().start()
+    
+    def stop(self):
+        self._running = False
+        self.join()
+        self._bus.shutdown()
+    
+    def sectors(self):
+        layout = stm32.FLASH_LAYOUT.get(self.chip_id, ((len(self.flash) // 2048, 2048),))
+        sectors = []
+        address = self.flash_base
+        for count, size in layout:
+            for _ in range(count):
+                if address - self.flash_base >= len(self.flash):
+                    return sectors
+                sectors.append((address, size,))
+                address += size
+        return sectors
+    
+    def _send(self, arb_id, data=()):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            self.frames_dropped += 1
+            return
+        self._bus.send(self._message(arb_id, data))
+        self.frames_sent += 1
+    
+    def _message(self, arb_id, data):
+        return can.Message(arbitration_id=arb_id, data=data, is_extended_id=False, is_fd=self.fd, bitrate_switch=self.fd)
+    
+    def _frame_length(self, size):
+        size = min(size, self.frame_size)
+        if self.fd:
+            while can.util.dlc2len(can.util.len2dlc(size)) != size:
+                size -= 1
+        return size
+    
+    def _valid_length(self, frame):
+        return self._frame_length(len(frame.data)) == len(frame.data)
+    
+    def _ack(self, cmd):
+        self._send(cmd, (stm32.BYTE_ACK,))
+    
+    def _nack(self, cmd):
+        self.nacks_sent += 1
+        self._send(cmd, (stm32.BYTE_NOACK,))
+    
+    def _inject_nack(self):
+        return self.nack_rate and self._random.random() < self.nack_rate
+    
+    def _expect(self, arb_id):
+        deadline = time.monotonic() + self.FRAME_TIMEOUT
+        while self._running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.0:
+                return None
+            msg = self._bus.recv(remaining)
+            if msg != None and not msg.is_error_frame:
+                self.frames_received += 1
+                if msg.arbitration_id == arb_id:
+                    return msg
+        return None
+    
+    def _flash_range(self, address, size):
+        offset = address - self.flash_base
+        if offset < 0 or offset + size > len(self.flash):
+            return None
+        return offset
+    
+    def run(self):
+        while self._running:
+            msg = self._bus.recv(0.05)
+            if msg == None or msg.is_error_frame:
+                continue
+            self.frames_received += 1
+            handler = self._handlers.get(msg.arbitration_id)
+            if handler == None:
+                continue
+            if msg.arbitration_id != stm32.BYTE_INIT and msg.arbitration_id not in self.commands:
+                self._nack(msg.arbitration_id)
+                continue
+            if self._inject_nack():
+                self._nack(msg.arbitration_id)
+                continue
+            handler(msg)
+    
+    def _do_init(self, msg):
+        self._ack(stm32.BYTE_INIT)
+    
+    def _do_get_commands(self, msg):
+        cmd = stm32.CMD_GET_COMMANDS
+        self._ack(cmd)
+        self._send(cmd, (len(self.commands),))
+        self._send(cmd, (self.version,))
+        for c in self.commands:
+            self._send(cmd, (c,))
+        self._ack(cmd)
+    
+    def _do_get_version(self, msg):
+        cmd = stm32.CMD_GET_VERSION
+        self._ack(cmd)
+        self._send(cmd, (self.version,))
+        self._send(cmd, (0x00, 0xFF if self.read_protection else 0x00))
+        self._ack(cmd)
+    
+    def _do_get_id(self, msg):
+        cmd = stm32.CMD_GET_ID
+        self._ack(cmd)
+        self._send(cmd, struct.pack('>H', self.chip_id))
+        self._ack(cmd)
+    
+    def _do_change_speed(self, msg):
+        cmd = stm32.CMD_CHANGE_SPEED
+        if len(msg.data) != 1 or msg.data[0] not in (1, 2, 3, 4):
+            self._nack(cmd)
+            return
+        self._ack(cmd)
+        if self.bitrate != None:
+            self.bitrate = stm32.SPEEDS[msg.data[0] - 1]
+            self._bus.shutdown()
+            self._bus = can.interface.Bus(channel=bitrate_channel(self.channel, self.bitrate), interface=self.interface)
+        self._ack(cmd)
+    
+    def _do_read_memory(self, msg):
+        cmd = stm32.CMD_READ_MEMORY
+        if len(msg.data) != 5 or self.read_protection:
+            self._nack(cmd)
+            return
+        address, size = struct.unpack('>IB', msg.data)
+        size += 1
+        offset = self._flash_range(address, size)
+        if offset == None:
+            self._nack(cmd)
+            return
+        self._ack(cmd)
+        i = offset
+        while i < offset + size:
+            n = self._frame_length(offset + size - i)
+            self._send(cmd, self.flash[i:i+n])
+            i += n
+        self._ack(cmd)
+    
+    def _do_go(self, msg):
+        cmd = stm32.CMD_GO
+        if len(msg.data) != 4:
+            self._nack(cmd)
+            return
+        self._ack(cmd)
+        self.started_at = struct.unpack('>I', msg.data)[0]
+    
+    def _do_write_memory(self, msg):
+        cmd = stm32.CMD_WRITE_MEMORY
+        if len(msg.data) != 5 or self.read_protection:
+            self._nack(cmd)
+            return
+        address, size = struct.unpack('>IB', msg.data)
+        size += 1
+        offset = self._flash_range(address, size)
+        if offset == None:
+            self._nack(cmd)
+            return
+        self._ack(cmd)
+        
+        data = bytearray()
+        while len(data) < size:
+            frame = self._expect(stm32.BYTE_DATA)
+            if frame == None:
+                return
+            if not self._valid_length(frame):
+                self._nack(cmd)
+                return
+            data += frame.data
+            if self._inject_nack():
+                self._nack(cmd)
+                return
+            self._ack(cmd)
+        
+        for i, b in enumerate(data[:size]):
+            self.flash[offset+i] &= b
+        self._ack(cmd)
+    
+    def _erase_sectors(self, numbers):
+        sectors = self.sectors()
+        for n in numbers:
+            if n >= len(sectors) or n in self.write_protected:
+                return False
+        for n in numbers:
+            address, size = sectors[n]
+            offset = address - self.flash_base
+            self.flash[offset:offset+size] = b'\xFF' * size
+            if self.erase_time:
+                time.sleep(self.erase_time)
+        return True
+    
+    def _receive_numbers(self, cmd, count):
+        numbers = []
+        while len(numbers) < count:
+            frame = self._expect(cmd)
+            if frame == None:
+                return None
+            if not self._valid_length(frame):
+                self._nack(cmd)
+                return None
+            numbers += frame.data
+            self._ack(cmd)
+        return numbers[:count]
+    
+    def _do_erase(self, msg):
+        cmd = stm32.CMD_ERASE
+        if len(msg.data) != 1 or self.read_protection:
+            self._nack(cmd)
+            return
+        self._ack(cmd)
+        if msg.data[0] == 0xFF:
+            self._erase_sectors(range(len(self.sectors())))
+            self._ack(cmd)
+            return
+        numbers = self._receive_numbers(cmd, msg.data[0] + 1)
+        if numbers == None:
+            return
+        if self._erase_sectors(numbers):
+            self._ack(cmd)
+        else:
+            self._nack(cmd)
+    
+    def _do_write_protect(self, msg):
+        cmd = stm32.CMD_WRITE_PROTECT
+        if len(msg.data) != 1 or self.read_protection:
+            self._nack(cmd)
+            return
+        self._ack(cmd)
+        numbers = self._receive_numbers(cmd, msg.data[0] + 1)
+        if numbers == None:
+            return
+        self.write_protected.update(numbers)
+        self._ack(cmd)
+    
+    def _do_write_unprotect(self, msg):
+        cmd = stm32.CMD_WRITE_UNPROTECT
+        self._ack(cmd)
+        self.write_protected.clear()
+        self._ack(cmd)
+    
+    def _do_readout_protect(self, msg):
+        cmd = stm32.CMD_READOUT_PROTECT
+        self._ack(cmd)
+        self.read_protection = True
+        self._ack(cmd)
+    
+    def _do_readout_unprotect(self, msg):
+        cmd = stm32.CMD_READOUT_UNPROTECT
+        self._ack(cmd)
+        self.read_protection = False
+        self.write_protected.clear()
+        self.flash[:] = b'\xFF' * len(self.flash)
+        self._ack(cmd)
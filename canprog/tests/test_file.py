@@ -0,0 +1,209 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import io
+import os
+import tempfile
+import unittest
+
+from canprog import file
+
+RECORD = ':10010000214601360121470136007EFE09D2190140'
+RECORD_DATA = bytes.fromhex('214601360121470136007EFE09D21901')
+
+class TestHexRecord(unittest.TestCase):
+    
+    def test_write(self):
+        self.assertEqual(file.hex_record(file.HEX_DATA, 0x0100, RECORD_DATA), RECORD + '\n')
+        self.assertEqual(file.hex_record(file.HEX_EOF, 0), ':00000001FF\n')
+        self.assertEqual(file.hex_record(file.HEX_EXTENDED_LINEAR_ADDRESS, 0, b'\x08\x00'), ':020000040800F2\n')
+    
+    def test_parse(self):
+        self.assertEqual(file.parse_hex_record(RECORD), (file.HEX_DATA, 0x0100, RECORD_DATA))
+        self.assertEqual(file.parse_hex_record(':00000001FF'), (file.HEX_EOF, 0, b''))
+    
+    def test_round_trip(self):
+        for rtype, address, data in ((file.HEX_DATA, 0xFFF0, bytes(range(16))), (file.HEX_EXTENDED_SEGMENT_ADDRESS, 0, b'\x12\x00'), (file.HEX_DATA, 0, b'')):
+            self.assertEqual(file.parse_hex_record(file.hex_record(rtype, address, data).strip()), (rtype, address, data))
+    
+    def test_checksum_error(self):
+        with self.assertRaisesRegex(ValueError, 'checksum'):
+            file.parse_hex_record(RECORD[:-2] + '41')
+    
+    def test_length_error(self):
+        with self.assertRaisesRegex(ValueError, 'length'):
+            file.parse_hex_record(RECORD[:-4] + '40')
+        with self.assertRaisesRegex(ValueError, 'length'):
+            file.parse_hex_record(':0000')
+    
+    def test_invalid_record(self):
+        for line in ('10010000214601360121470136007EFE09D2190140', ':1001000021460136012147013600ZZFE09D2190140', ':123'):
+            with self.assertRaises(ValueError):
+                file.parse_hex_record(line)
+
+class TestReadHex(unittest.TestCase):
+    
+    def read(self, lines):
+        return list(file.read_hex(io.StringIO('\n'.join(lines) + '\n')))
+    
+    def test_extended_linear_address(self):
+        records = self.read([':020000040800F2', RECORD, ':00000001FF'])
+        self.assertEqual(records, [(0x08000100, RECORD_DATA)])
+    
+    def test_extended_segment_address(self):
+        records = self.read([':020000021200EA', ':0100000055AA', ':00000001FF'])
+        self.assertEqual(records, [(0x12000, b'\x55')])
+    
+    def test_stops_at_eof(self):
+        records = self.read([RECORD, ':00000001FF', ':0100000055AA'])
+        self.assertEqual(records, [(0x0100, RECORD_DATA)])
+    
+    def test_start_address_ignored(self):
+        records = self.read([':040000050800018965', RECORD, ':00000001FF'])
+        self.assertEqual(records, [(0x0100, RECORD_DATA)])
+    
+    def test_error_line(self):
+        with self.assertRaisesRegex(ValueError, 'checksum at line 2'):
+            self.read([':020000040800F2', RECORD[:-2] + '00'])
+    
+    def test_unsupported_type(self):
+        with self.assertRaisesRegex(ValueError, 'Unsupported hex record type at line 1'):
+            self.read([':00000006FA'])
+
+class FileTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+    
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+class TestFileManager(FileTestCase):
+    
+    def test_hex_round_trip(self):
+        data = bytes(i & 0xFF for i in range(0x300))
+        manager = file.FileManager()
+        manager.set_segment(0x0800FF00, data)
+        manager.set_segment(0x08020000, b'\x01\x02\x03')
+        manager.save(self.path('image.hex'), 'hex')
+        
+        with open(self.path('image.hex')) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], ':020000040800F2')
+        self.assertIn(':020000040801F1', lines)
+        self.assertIn(':020000040802F0', lines)
+        self.assertEqual(lines[-1], ':00000001FF')
+        
+        loaded = file.FileManager()
+        loaded.load(self.path('image.hex'), 'hex')
+        self.assertEqual([(address, bytes(data)) for address, data in loaded.get_segments()], [(0x0800FF00, data), (0x08020000, b'\x01\x02\x03')])
+    
+    def test_bin_gap(self):
+        manager = file.FileManager()
+        manager.set_segment(0x08000000, b'\x01\x02')
+        manager.set_segment(0x08000010, b'\x03')
+        manager.save(self.path('image.bin'), 'bin')
+        with open(self.path('image.bin'), 'rb') as f:
+            self.assertEqual(f.read(), b'\x01\x02' + b'\xFF' * 14 + b'\x03')
+    
+    def test_bin_load(self):
+        with open(self.path('image.bin'), 'wb') as f:
+            f.write(b'\x01\x02\x03')
+        manager = file.FileManager()
+        manager.load(self.path('image.bin'), 'bin', 0x08000000)
+        self.assertEqual(manager.get_data(0x08000001, 2), b'\x02\x03')
+        self.assertEqual(manager.get_data(0x08000001, 3), None)
+    
+    def test_overlap(self):
+        manager = file.FileManager()
+        manager.set_segment(0x100, b'\x00' * 4)
+        manager.set_segment(0x102, b'\x01' * 4)
+        manager.set_segment(0x106, b'\x02')
+        self.assertEqual([(address, bytes(data)) for address, data in manager.get_segments()], [(0x100, b'\x00\x00\x01\x01\x01\x01\x02')])
+
+class TestFileSink(FileTestCase):
+    
+    def image(self, size):
+        return bytes((i * 7) & 0xFF for i in range(size))
+    
+    def test_bin_resume_truncates_partial_page(self):
+        data = self.image(1024)
+        with open(self.path('dump.bin'), 'wb') as f:
+            f.write(data[:600])
+        sink = file.FileSink(self.path('dump.bin'), 'bin', 0x08000000, resume=True)
+        self.assertEqual(sink.address, 0x08000200)
+        sink(0x08000200, data[512:])
+        sink.close()
+        with open(self.path('dump.bin'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+    
+    def test_bin_no_resume(self):
+        with open(self.path('dump.bin'), 'wb') as f:
+            f.write(b'\x00' * 600)
+        sink = file.FileSink(self.path('dump.bin'), 'bin', 0x08000000)
+        self.assertEqual(sink.address, 0x08000000)
+        sink.close()
+        self.assertEqual(os.path.getsize(self.path('dump.bin')), 0)
+    
+    def test_hex_resume_truncates_partial_record(self):
+        data = self.image(0x400)
+        sink = file.FileSink(self.path('dump.hex'), 'hex', 0x0800FE00)
+        sink(0x0800FE00, data[:0x300])
+        sink._f.close()
+        with open(self.path('dump.hex'), 'ab') as f:
+            f.write(b':1001')
+        
+        sink = file.FileSink(self.path('dump.hex'), 'hex', 0x0800FE00, resume=True)
+        self.assertEqual(sink.address, 0x08010100)
+        sink(0x08010100, data[0x300:])
+        sink.close()
+        
+        manager = file.FileManager()
+        manager.load(self.path('dump.hex'), 'hex')
+        self.assertEqual([(address, bytes(segment)) for address, segment in manager.get_segments()], [(0x0800FE00, data)])
+    
+    def test_hex_resume_missing_file(self):
+        sink = file.FileSink(self.path('dump.hex'), 'hex', 0x08000000, resume=True)
+        self.assertEqual(sink.address, 0x08000000)
+        sink.close()
+        with open(self.path('dump.hex')) as f:
+            self.assertEqual(f.read(), ':00000001FF\n')
+    
+    def test_hex_scan_stops_at_gap(self):
+        f = io.BytesIO((file.hex_record(file.HEX_EXTENDED_LINEAR_ADDRESS, 0, b'\x08\x00') + file.hex_record(file.HEX_DATA, 0, b'\x01\x02') + file.hex_record(file.HEX_DATA, 0x10, b'\x03')).encode('ascii'))
+        self.assertEqual(file.scan_hex(f, 0x08000000), (len(':020000040800F2\n') + len(':020000000102FB\n'), 0x08000002))
+    
+    def test_non_contiguous(self):
+        sink = file.FileSink(self.path('dump.bin'), 'bin', 0x08000000)
+        self.addCleanup(sink.close)
+        with self.assertRaises(ValueError):
+            sink(0x08000100, b'\x00')
+    
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            file.FileSink(self.path('dump.srec'), 'srec', 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import subprocess
+import sys
+import time
+import unittest
+
+IMPORT_BUDGET_MS = 100.0
+RUNS = 5
+HEAVY_MODULES = ('can', 'asyncio', 'http.server', 'intelhex')
+CONSOLE_SCRIPT = 'import sys; from canprog.main import main; sys.exit(main())'
+
+def import_times(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import '+module], stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative_us)
+    return times
+
+def run_time(args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) * 1000.0
+
+def command_time(args):
+    '''
+    Best wall time of the console script with args, less the best time of
+    an interpreter that does nothing.
+    '''
+    baseline = min(run_time(['-c', 'pass']) for n in range(RUNS))
+    return min(run_time(['-c', CONSOLE_SCRIPT] + args) for n in range(RUNS)) - baseline
+
+class TestStartup(unittest.TestCase):
+    
+    def test_no_heavy_imports(self):
+        times = import_times('canprog.main')
+        heavy = [name for name in HEAVY_MODULES if name in times]
+        self.assertEqual(heavy, [])
+    
+    def test_import_budget(self):
+        best = min(import_times('canprog.main')['canprog.main'] for n in range(RUNS)) / 1000.0
+        self.assertLessEqual(best, IMPORT_BUDGET_MS)
+    
+    def test_version_budget(self):
+        self.assertLessEqual(command_time(['--version']), IMPORT_BUDGET_MS)
+    
+    def test_help_budget(self):
+        self.assertLessEqual(command_time(['--help']), IMPORT_BUDGET_MS)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,346 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import asyncio
+import can
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import canprog.logger
+from canprog import main, trace
+from canprog.protocols import stm32
+from canprog.tests.simulator import STM32Simulator
+
+def setUpModule():
+    canprog.logger.set_level(logging.CRITICAL)
+
+def tearDownModule():
+    canprog.logger.set_level(logging.INFO)
+
+class SimulatorTestCase(unittest.TestCase):
+    
+    SIMULATOR = {}
+    
+    def setUp(self):
+        self.channel = self.id()
+        self.cache = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache.cleanup)
+        environ = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache.name})
+        environ.start()
+        self.addCleanup(environ.stop)
+        
+        self.sim = STM32Simulator(self.channel, seed=1, **self.SIMULATOR)
+        self.sim.start()
+        self.addCleanup(self.sim.stop)
+        self.bus = can.interface.Bus(channel=self.channel, interface='virtual')
+        self.addCleanup(self.bus.shutdown)
+    
+    def image(self, size):
+        return bytes(random.Random(size).getrandbits(8) for i in range(size))
+
+class TestSTM32Protocol(SimulatorTestCase):
+    
+    PROTOCOL = stm32.STM32Protocol
+    
+    def setUp(self):
+        super().setUp()
+        self.protocol = self.PROTOCOL(self.bus)
+        self.protocol.RECV_TIMEOUT = 0.2
+        self.protocol.connect()
+    
+    def test_connect(self):
+        self.assertEqual(self.protocol.chip_id, '0x0413')
+        self.assertEqual(self.protocol.timeouts, 0)
+    
+    def test_ping_absent(self):
+        bus = can.interface.Bus(channel=self.channel + '-missing', interface='virtual')
+        self.addCleanup(bus.shutdown)
+        protocol = self.PROTOCOL(bus)
+        protocol.RECV_TIMEOUT = 0.1
+        self.assertFalse(protocol.ping())
+        self.assertEqual(protocol.timeouts, 0)
+        with self.assertRaises(TimeoutError):
+            protocol.connect()
+        self.assertEqual(protocol.timeouts, 1)
+    
+    def test_erase_sectors(self):
+        self.sim.flash[:0xC000] = b'\x00' * 0xC000
+        self.protocol.erase([0, 1])
+        self.assertEqual(self.sim.flash[:0x8000], b'\xFF' * 0x8000)
+        self.assertEqual(self.sim.flash[0x8000:0xC000], b'\x00' * 0x4000)
+    
+    def test_erase_many_sectors(self):
+        self.sim.flash[:0xA0000] = b'\x00' * 0xA0000
+        self.protocol.erase(list(range(9)))
+        self.assertEqual(self.sim.flash[:0xA0000], b'\xFF' * 0xA0000)
+        self.assertEqual(self.sim.nacks_sent, 0)
+    
+    def test_mass_erase(self):
+        self.sim.flash[:] = b'\x00' * len(self.sim.flash)
+        self.protocol.erase([])
+        self.assertEqual(self.sim.flash, b'\xFF' * len(self.sim.flash))
+    
+    def test_erase_nack(self):
+        self.sim.flash[:0x8000] = b'\x00' * 0x8000
+        self.protocol.RECV_TIMEOUT = 5.0
+        start = time.monotonic()
+        with self.assertRaises(ConnectionError):
+            self.protocol.erase([0, 1, 40])
+        self.assertLess(time.monotonic() - start, 2.0)
+        self.assertGreater(self.protocol.nacks, 0)
+        self.assertEqual(self.sim.flash[:0x8000], b'\xFF' * 0x8000)
+    
+    def test_erase_page_out_of_range(self):
+        with self.assertRaises(ValueError):
+            self.protocol.erase([stm32.MAX_ERASE_PAGE + 1])
+    
+    def test_write_read(self):
+        data = self.image(3000)
+        self.protocol.write(stm32.FLASH_BASE, data)
+        self.assertEqual(bytes(self.sim.flash[:len(data)]), data)
+        self.assertEqual(bytes(self.protocol.read(stm32.FLASH_BASE, len(data))), data)
+    
+    def test_write_window(self):
+        data = self.image(3000)
+        self.protocol.write_window = 8
+        self.protocol.write(stm32.FLASH_BASE, data)
+        self.assertEqual(bytes(self.sim.flash[:len(data)]), data)
+    
+    def test_read_pipeline(self):
+        data = self.image(3000)
+        self.sim.flash[:len(data)] = data
+        self.protocol.read_pipeline = True
+        self.assertEqual(bytes(self.protocol.read(stm32.FLASH_BASE, len(data))), data)
+    
+    def test_nack_retry(self):
+        data = self.image(8192)
+        self.protocol.write_retry = stm32.RetryPolicy(10, backoff=0.0)
+        self.protocol.read_retry = stm32.RetryPolicy(10, backoff=0.0)
+        self.sim.nack_rate = 0.01
+        self.protocol.write(stm32.FLASH_BASE, data)
+        self.assertEqual(bytes(self.protocol.read(stm32.FLASH_BASE, len(data))), data)
+        self.assertGreater(self.protocol.nacks, 0)
+        self.assertGreater(self.protocol.retries, 0)
+    
+    def test_trace_rx(self):
+        tracer = self.protocol.tracer = trace.Tracer(self.channel)
+        other = can.interface.Bus(channel=self.channel, interface='virtual')
+        self.addCleanup(other.shutdown)
+        other.send(can.Message(arbitration_id=0x55, data=(1,), is_extended_id=False))
+        time.sleep(0.2)
+        self.protocol._drain()
+        self.assertEqual([event.arbitration_id for event in tracer.events], [0x55])
+        self.assertGreater(trace.current_time() - tracer.events[0].time, 0.1)
+    
+    def test_drop_retry(self):
+        data = self.image(2048)
+        self.sim.FRAME_TIMEOUT = 0.05
+        self.protocol.write_retry = stm32.RetryPolicy(10, backoff=0.1)
+        self.protocol.read_retry = stm32.RetryPolicy(10, backoff=0.1)
+        self.sim.drop_rate = 0.005
+        self.protocol.write(stm32.FLASH_BASE, data)
+        self.assertEqual(bytes(self.protocol.read(stm32.FLASH_BASE, len(data))), data)
+        self.assertGreater(self.sim.frames_dropped, 0)
+        self.assertGreater(self.protocol.retries, 0)
+    
+    def test_retries_exhausted(self):
+        self.protocol.write_retry = stm32.RetryPolicy(0)
+        self.sim.nack_rate = 1.0
+        with self.assertRaises(ConnectionError):
+            self.protocol.write(stm32.FLASH_BASE, self.image(256))
+
+class TestSTM32FDProtocol(TestSTM32Protocol):
+    
+    SIMULATOR = {'fd': True}
+    PROTOCOL = stm32.STM32FDProtocol
+
+class TestAsyncSTM32Protocol(SimulatorTestCase):
+    
+    def test_write_read(self):
+        data = self.image(3000)
+        async def run():
+            protocol = stm32.AsyncSTM32Protocol(self.bus)
+            try:
+                await protocol.connect()
+                await protocol.erase([0])
+                await protocol.write(stm32.FLASH_BASE, data)
+                return bytes(await protocol.read(stm32.FLASH_BASE, len(data)))
+            finally:
+                await protocol.disconnect()
+                protocol._stop()
+        self.assertEqual(asyncio.run(run()), data)
+        self.assertEqual(bytes(self.sim.flash[:len(data)]), data)
+
+    def test_ping_before_connect(self):
+        async def run():
+            protocol = stm32.AsyncSTM32Protocol(self.bus)
+            try:
+                return await protocol.ping()
+            finally:
+                protocol._stop()
+        self.assertTrue(asyncio.run(run()))
+    
+    def test_nack_retry(self):
+        data = self.image(8192)
+        self.sim.nack_rate = 0.01
+        async def run():
+            protocol = stm32.AsyncSTM32Protocol(self.bus)
+            protocol.write_window = 8
+            protocol.write_retry = stm32.RetryPolicy(10, backoff=0.0)
+            protocol.read_retry = stm32.RetryPolicy(10, backoff=0.0)
+            try:
+                await protocol.connect()
+                await protocol.write(stm32.FLASH_BASE, data)
+                self.assertEqual(bytes(await protocol.read(stm32.FLASH_BASE, len(data))), data)
+                return protocol.retries
+            finally:
+                await protocol.disconnect()
+        self.assertGreater(asyncio.run(run()), 0)
+        self.assertGreater(self.sim.nacks_sent, 0)
+    
+    def test_erase_nack(self):
+        async def run():
+            protocol = stm32.AsyncSTM32Protocol(self.bus)
+            try:
+                await protocol.connect()
+                with self.assertRaises(ConnectionError):
+                    await asyncio.wait_for(protocol.erase([0, 40]), 2.0)
+                return protocol.nacks
+            finally:
+                protocol._stop()
+        self.assertGreater(asyncio.run(run()), 0)
+
+class CommandTestCase(SimulatorTestCase):
+    
+    PROTOCOL = 'stm32'
+    
+    def setUp(self):
+        super().setUp()
+        self.data = self.image(20000)
+        self.filename = os.path.join(self.cache.name, 'image.bin')
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+    
+    def run_command(self, args):
+        params = main.config_parser().parse_args(['-f', 'bin', self.PROTOCOL] + args)
+        image = None
+        if params.command == 'write':
+            image = main.ImagePreparer(self.filename, 'bin', params.address)
+        main.run(params, self.channel, self.bus, image)
+    
+    def run_write(self, options, args):
+        self.run_command(options + ['write', self.filename] + args)
+    
+    def assertWritten(self):
+        self.assertEqual(bytes(self.sim.flash[:len(self.data)]), self.data)
+
+class TestWriteCommand(CommandTestCase):
+    
+    def test_write_verify(self):
+        self.sim.flash[:0x8000] = b'\x00' * 0x8000
+        self.run_write([], ['-e', '-v'])
+        self.assertEqual(bytes(self.sim.flash[:len(self.data)]), self.data)
+        self.assertEqual(self.sim.flash[len(self.data):0x8000], b'\xFF' * (0x8000 - len(self.data)))
+    
+    def test_resume(self):
+        handler = self.sim._handlers[stm32.CMD_WRITE_MEMORY]
+        pages = []
+        lost = [40]
+        def counting(msg):
+            pages.append(msg)
+            if len(pages) not in lost:
+                handler(msg)
+        self.sim._handlers[stm32.CMD_WRITE_MEMORY] = counting
+        with self.assertRaises(ConnectionError):
+            self.run_write(['--write-retries', '0'], ['-e'])
+        self.assertNotEqual(bytes(self.sim.flash[:len(self.data)]), self.data)
+        
+        del pages[:]
+        del lost[:]
+        self.run_write([], ['-v', '--resume'])
+        self.assertEqual(bytes(self.sim.flash[:len(self.data)]), self.data)
+        self.assertEqual(len(pages), (len(self.data) + 255) // 256 - 39)
+        self.assertEqual([name for name in os.listdir(os.path.join(self.cache.name, 'canprog')) if name.startswith('write-')], [])
+    
+    def test_delta_cache_after_erase(self):
+        self.run_write([], ['-e', '-d', 'cache'])
+        self.run_command(['erase'])
+        self.run_write([], ['-d', 'cache'])
+        self.assertWritten()
+    
+    def test_delta_cache_after_plain_write(self):
+        self.run_write([], ['-e', '-d', 'cache'])
+        self.run_command(['erase', '-P', '0'])
+        self.run_write([], ['-e'])
+        self.sim.flash[:0x4000] = b'\xFF' * 0x4000
+        self.run_write([], ['-d', 'cache'])
+        self.assertWritten()
+
+class TestFDWriteCommand(TestWriteCommand):
+    
+    SIMULATOR = {'fd': True}
+    PROTOCOL = 'stm32fd'
+
+class TestUnknownLayout(CommandTestCase):
+    
+    SIMULATOR = {'chip_id': 0x999}
+    
+    def test_delta_read_erases(self):
+        self.sim.flash[:len(self.data)] = bytes(len(self.data))
+        self.run_write([], ['-d', 'read', '-v'])
+        self.assertWritten()
+    
+    def test_delta_cache_erases(self):
+        self.sim.flash[:len(self.data)] = bytes(len(self.data))
+        self.run_write([], ['-d', 'cache', '-v'])
+        self.assertWritten()
+
+class TestMain(CommandTestCase):
+    
+    def run_main(self, args):
+        bus = mock.patch.object(main, 'open_bus', lambda interface, name, bitrate=None, fd=False: can.interface.Bus(channel=name, interface='virtual'))
+        argv = mock.patch.object(sys, 'argv', ['canprog'] + args)
+        with bus, argv, self.assertRaises(SystemExit) as cm:
+            main.main()
+        return cm.exception.code
+    
+    def test_exit_success(self):
+        self.assertEqual(self.run_main(['-n', self.channel, '-f', 'bin', 'stm32', 'write', self.filename, '-e']), 0)
+        self.assertWritten()
+    
+    def test_exit_failure(self):
+        self.assertEqual(self.run_main(['-n', self.channel + '-missing', 'stm32', 'erase']), 1)
+    
+    def test_exit_batch_failure(self):
+        self.assertEqual(self.run_main(['-n', self.channel, '-n', self.channel + '-missing', '-f', 'bin', 'stm32', 'write', self.filename, '-e']), 1)
+        self.assertWritten()
+
+if __name__ == '__main__':
+    unittest.main()
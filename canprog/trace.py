@@ -0,0 +1,128 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import collections
+import json
+import time
+
+current_time = time.monotonic
+
+CANFD_BRS = 0x1
+
+Event = collections.namedtuple('Event', 'time direction arbitration_id is_extended_id is_fd bitrate_switch dlc data latency')
+
+class Tracer(object):
+    '''
+    Records every frame a protocol sends and receives. A received frame is
+    matched with the oldest unanswered frame expecting a reply on its ID and
+    its latency is the time between them. Frames that answer nothing (read
+    data) get the time since the last frame expecting a reply on their ID.
+    Received frames are stamped with the bus timestamp when it has one.
+    Unanswered frames are kept up to PENDING_SIZE per ID.
+    '''
+    
+    PENDING_SIZE = 64
+    
+    def __init__(self, channel):
+        self.channel = channel
+        self.events = []
+        self._start = current_time()
+        self._start_wall = time.time()
+        self._pending = {}
+        self._last_sent = {}
+    
+    def frame(self, direction, msg, reply_id=None):
+        if direction == 'RX' and msg.timestamp:
+            t = self._start + (msg.timestamp - self._start_wall)
+        else:
+            t = current_time()
+        aid = msg.arbitration_id
+        latency = None
+        if direction == 'TX':
+            if reply_id == None:
+                reply_id = aid
+            queue = self._pending.get(reply_id)
+            if queue == None:
+                queue = self._pending[reply_id] = collections.deque(maxlen=self.PENDING_SIZE)
+            queue.append(t)
+            self._last_sent[reply_id] = t
+        else:
+            queue = self._pending.get(aid)
+            if queue:
+                latency = t - queue.popleft()
+            elif aid in self._last_sent:
+                latency = t - self._last_sent[aid]
+        self.events.append(Event(t, direction, aid, msg.is_extended_id, msg.is_fd, msg.bitrate_switch, msg.dlc, bytes(msg.data), latency))
+    
+    def wall_time(self, t):
+        return self._start_wall + (t - self._start)
+
+def _merged(tracers):
+    events = [(event.time, index, tracer, event) for index, tracer in enumerate(tracers) for event in tracer.events]
+    events.sort(key=lambda item: (item[0], item[1]))
+    for _, index, tracer, event in events:
+        yield index, tracer, event
+
+def write_candump(f, tracers):
+    for _, tracer, event in _merged(tracers):
+        if event.is_extended_id:
+            aid = '{:08X}'.format(event.arbitration_id)
+        else:
+            aid = '{:03X}'.format(event.arbitration_id)
+        if event.is_fd:
+            separator = '##{:X}'.format(CANFD_BRS if event.bitrate_switch else 0)
+        else:
+            separator = '#'
+        f.write('({time:.6f}) {channel} {aid}{separator}{data}\n'.format(time=tracer.wall_time(event.time), channel=tracer.channel, aid=aid, separator=separator, data=event.data.hex().upper()))
+
+def write_chrome(f, tracers):
+    start = min([tracer._start for tracer in tracers] or [0.0])
+    trace = []
+    for index, tracer in enumerate(tracers):
+        trace.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': index, 'args': {'name': tracer.channel}})
+    for index, tracer, event in _merged(tracers):
+        args = {'id': '0x{:03X}'.format(event.arbitration_id), 'dlc': event.dlc, 'data': event.data.hex().upper()}
+        name = '{direction} 0x{aid:03X}'.format(direction=event.direction, aid=event.arbitration_id)
+        ts = (event.time - start) * 1e6
+        if event.latency == None:
+            trace.append({'name': name, 'ph': 'i', 's': 't', 'pid': 1, 'tid': index, 'ts': ts, 'args': args})
+        else:
+            args['latency_ms'] = round(event.latency * 1e3, 3)
+            dur = event.latency * 1e6
+            trace.append({'name': name, 'ph': 'X', 'pid': 1, 'tid': index, 'ts': ts - dur, 'dur': dur, 'args': args})
+    json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+WRITERS = {
+    'candump': write_candump,
+    'chrome': write_chrome,
+}
+
+def save(filename, fmt, tracers):
+    if fmt == None:
+        if filename.endswith('.json'):
+            fmt = 'chrome'
+        else:
+            fmt = 'candump'
+    with open(filename, 'w') as f:
+        WRITERS[fmt](f, tracers)
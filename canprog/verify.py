@@ -0,0 +1,71 @@
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Marcin Borowicz <marcinbor85@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import random
+
+PAGE_SIZE = 256
+
+def find_mismatch(address, expected, actual):
+    for i in range(0, len(expected), PAGE_SIZE):
+        if expected[i:i+PAGE_SIZE] != actual[i:i+PAGE_SIZE]:
+            for j in range(i, min(i+PAGE_SIZE, len(expected))):
+                if expected[j] != actual[j]:
+                    return address + j, actual[j], expected[j]
+    return None
+
+def check(address, expected, actual):
+    if len(actual) != len(expected):
+        raise ValueError('Size mismatch {} != {}'.format(len(actual),len(expected)))
+    if actual == expected:
+        return
+    mismatch = find_mismatch(address, expected, actual)
+    if mismatch != None:
+        raise ValueError('Mismatch at 0x{address:08X} 0x{:02X}!=0x{:02X}'.format(mismatch[1], mismatch[2], address=mismatch[0]))
+
+class FullVerify(object):
+    
+    def verify(self, protocol, address, data):
+        check(address, bytes(data), bytes(protocol.read(address, len(data))))
+
+class SampledVerify(object):
+    
+    SAMPLE_PAGES = 16
+    
+    def __init__(self, pages=None):
+        self._pages = self.SAMPLE_PAGES if pages == None else pages
+    
+    def verify(self, protocol, address, data):
+        data = bytes(data)
+        offsets = range(0, len(data), PAGE_SIZE)
+        for offset in sorted(random.sample(offsets, min(self._pages, len(offsets)))):
+            expected = data[offset:offset+PAGE_SIZE]
+            check(address + offset, expected, bytes(protocol.read(address + offset, len(expected))))
+
+def get_verifier_by_name(name):
+    if name == 'full':
+        return FullVerify()
+    elif name == 'sample':
+        return SampledVerify()
+    else:
+        raise NotImplementedError('unknown verify type')
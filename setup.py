@@ -46,7 +46,7 @@ setup(
     packages=['canprog', 'canprog.protocols', 'canprog.tests'],
     long_description=read('DESCRIPTION'),
     install_requires=[
-        "intelhex", "python-can",
+        "python-can",
     ],
     classifiers=[
         "Development Status :: 3 - Alpha",